@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+###
+# Copyright (c) 2022, Mike Oxlong
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""Benchmarks for the Blacklist hot paths.
+
+Builds synthetic banlists and join streams against a real plugin instance
+with a fake Irc, and reports latency percentiles and throughput for join
+matching (including joins right after a write), ban mutations and their
+persistence, cleanup and list export.
+Results are written as JSON so two runs can be compared:
+
+    python3 Blacklist/benchmark.py --sizes 1000,100000 -o new.json
+    python3 Blacklist/benchmark.py --sizes 1000,100000 --compare old.json
+
+Everything the bot writes (registry, logs, databases) goes to a temporary
+directory, like supybot-test does.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+CHANNEL = '#bench'
+
+
+def _openRegistry(tmpdir):
+    """Point supybot at <tmpdir>.  Must run before supybot.conf is imported."""
+    for name in ('conf', 'data', 'logs'):
+        os.makedirs(os.path.join(tmpdir, name))
+    filename = os.path.join(tmpdir, 'conf', 'bench.conf')
+    with open(filename, 'w') as fd:
+        fd.write(f"""
+supybot.directories.backup: /dev/null
+supybot.directories.conf: {os.path.join(tmpdir, 'conf')}
+supybot.directories.data: {os.path.join(tmpdir, 'data')}
+supybot.directories.log: {os.path.join(tmpdir, 'logs')}
+supybot.log.stdout: False
+supybot.log.plugins.individualLogfiles: False
+supybot.nick: bench
+""")
+    from supybot import registry
+    registry.open_registry(filename)
+
+
+class FakeIrc(object):
+    """Just enough of an Irc for the plugin: the bot opped in one channel
+    and an outbox that only counts what would have been sent"""
+    network = 'bench'
+    nick = 'bench'
+    prefix = 'bench!bench@bot.example'
+
+    def __init__(self, channel):
+        from supybot import irclib
+        self.state = irclib.IrcState()
+        self.state.supported['modes'] = 4
+        self.state.channels[channel] = irclib.ChannelState()
+        self.state.channels[channel].addUser('@' + self.nick)
+        self.sent = 0
+        self.replies = []
+
+    def queueMsg(self, msg):
+        self.sent += 1
+
+    sendMsg = queueMsg
+
+    def isNick(self, s):
+        from supybot import ircutils
+        return ircutils.isNick(s)
+
+    def reply(self, s, **kwargs):
+        self.replies.append(s)
+
+    error = reply
+
+
+class Workload(object):
+    """A deterministic synthetic banlist and the hostmasks hitting it.
+
+    The masks follow the kinds the plugin creates and users add: mostly
+    *!*@host, then *!*@*.domain, *!ident@*, full nick!user@host masks and
+    one in a thousand free-form patterns."""
+    kinds = [('host', 450), ('suffix', 250), ('ident', 199), ('exact', 100),
+             ('rest', 1)]
+
+    def __init__(self, size, seed):
+        self.random = random.Random(seed)
+        weights = [weight for kind, weight in self.kinds]
+        self.bans = []  # (kind, i)
+        for i, kind in enumerate(self.random.choices(
+                [kind for kind, weight in self.kinds], weights, k=size)):
+            self.bans.append((kind, i))
+
+    @staticmethod
+    def mask(kind, i):
+        if kind == 'host':
+            return f'*!*@h{i}.isp{i % 97}.example'
+        if kind == 'suffix':
+            return f'*!*@*.net{i}.example'
+        if kind == 'ident':
+            return f'*!spam{i}@*'
+        if kind == 'exact':
+            return f'n{i}!u{i}@h{i}.example'
+        return f'*bad{i}*!*@*'
+
+    @staticmethod
+    def victim(kind, i):
+        """A hostmask banned by mask(kind, i)"""
+        if kind == 'host':
+            return f'v{i}!~v@h{i}.isp{i % 97}.example'
+        if kind == 'suffix':
+            return f'v{i}!~v@c{i}.net{i}.example'
+        if kind == 'ident':
+            return f'v{i}!spam{i}@c{i}.example'
+        if kind == 'exact':
+            return f'n{i}!u{i}@h{i}.example'
+        return f'xbad{i}x!~v@c{i}.example'
+
+    def entries(self, now, expiredShare):
+        """(mask, entry) pairs, <expiredShare> of them a year old"""
+        adders = ['op%d' % n for n in range(20)]
+        reasons = ['spam', 'flood', 'ban evasion', 'abuse']
+        for kind, i in self.bans:
+            old = self.random.random() < expiredShare
+            yield (self.mask(kind, i),
+                   [self.random.choice(adders),
+                    int(now - (365 * 86400 if old else self.random.randrange(3600))),
+                    self.random.choice(reasons)])
+
+    def joins(self, count, hitRate):
+        """(nick, hostmask) pairs; about <hitRate> of them are banned"""
+        for j in range(count):
+            if self.bans and self.random.random() < hitRate:
+                kind, i = self.random.choice(self.bans)
+                prefix = self.victim(kind, i)
+            else:
+                prefix = f'g{j}!~g{j}@c{j}.clients.example'
+            yield prefix.split('!', 1)[0], prefix
+
+
+def _percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def _latencies(name, size, samples):
+    """Summarise per-operation timings, in nanoseconds"""
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {'benchmark': name, 'size': size, 'count': len(ordered),
+            'p50_us': round(_percentile(ordered, .5) / 1e3, 2),
+            'p90_us': round(_percentile(ordered, .9) / 1e3, 2),
+            'p99_us': round(_percentile(ordered, .99) / 1e3, 2),
+            'max_us': round(ordered[-1] / 1e3, 2),
+            'per_second': round(len(ordered) / (total / 1e9), 1) if total else None}
+
+
+def _throughput(name, size, count, seconds, **extra):
+    result = {'benchmark': name, 'size': size, 'count': count,
+              'seconds': round(seconds, 4),
+              'per_second': round(count / seconds, 1) if seconds else None}
+    result.update(extra)
+    return result
+
+
+def run(size, options, tmpdir):
+    """Benchmark one plugin instance holding a banlist of <size> masks"""
+    from supybot import conf, ircmsgs
+    from Blacklist import plugin
+
+    datadir = os.path.join(tmpdir, 'data', str(size))
+    os.makedirs(datadir)
+    conf.supybot.directories.data.setValue(datadir)
+    conf.supybot.plugins.Blacklist.storage.setValue(options.storage)
+    conf.supybot.plugins.Blacklist.enabled.setValue(True)
+    conf.supybot.plugins.Blacklist.cacheSize.setValue(max(size * 2, 100000))
+    conf.supybot.plugins.Blacklist.joinQueueSize.setValue(options.joins)
+
+    irc = FakeIrc(CHANNEL)
+    workload = Workload(size, options.seed)
+    cb = plugin.Class(irc)
+    results = []
+    try:
+        # Bulk load, as import does, then write it all out
+        entries = list(workload.entries(time.time(), options.expired))
+        started = time.perf_counter()
+        cb._db_setMany(CHANNEL, entries)
+        results.append(_throughput('load.insert', size, len(entries),
+                                   time.perf_counter() - started))
+        started = time.perf_counter()
+        cb._writer.flush()
+        results.append(_throughput('load.persist', size, len(entries),
+                                   time.perf_counter() - started))
+        del entries
+
+        # The first join builds the index and snapshot; time it on its own
+        joins = list(workload.joins(options.joins, options.hitRate))
+        started = time.perf_counter_ns()
+        cb._enforceJoins([(irc, CHANNEL) + joins[0]])
+        results.append(_latencies('join.first', size,
+                                  [time.perf_counter_ns() - started]))
+
+        # A lone join, matched as soon as it is taken off the queue
+        samples = []
+        for nick, prefix in joins:
+            started = time.perf_counter_ns()
+            cb._enforceJoins([(irc, CHANNEL, nick, prefix)])
+            samples.append(time.perf_counter_ns() - started)
+        results.append(_latencies('join.match', size, samples))
+
+        # A join flood through doJoin and the worker queue
+        msgs = [ircmsgs.join(CHANNEL, prefix=prefix) for nick, prefix in joins]
+        started = time.perf_counter()
+        for msg in msgs:
+            cb.doJoin(irc, msg)
+        cb._joins.drain(timeout=600)
+        elapsed = time.perf_counter() - started
+        metrics = cb._joins.metrics()
+        results.append(_throughput('join.flood', size, len(msgs), elapsed,
+                                   dropped=metrics['dropped'],
+                                   max_lag_ms=round(metrics['maxLag'] * 1e3, 2)))
+        cb._modes.flush()
+        del joins, msgs
+
+        # Bans added one by one, as the add command does, then persisted
+        msg = ircmsgs.privmsg(CHANNEL, 'add', prefix='op!op@op.example')
+        samples = []
+        for n in range(options.mutations):
+            mask = f'*!*@new{n}.example'
+            started = time.perf_counter_ns()
+            cb._ban(irc, msg, [], CHANNEL, mask, None, 'benchmark')
+            samples.append(time.perf_counter_ns() - started)
+        results.append(_latencies('mutate.ban', size, samples))
+        started = time.perf_counter()
+        cb._writer.flush()
+        results.append(_throughput('mutate.persist', size, options.mutations,
+                                   time.perf_counter() - started))
+        samples = []
+        for n in range(options.mutations):
+            mask = f'*!*@new{n}.example'
+            started = time.perf_counter_ns()
+            with cb._get_db():
+                cb._db_del(CHANNEL, mask)
+            cb._dbWrite()
+            samples.append(time.perf_counter_ns() - started)
+        results.append(_latencies('mutate.remove', size, samples))
+        cb._writer.flush()
+        cb._modes.flush()
+
+        # A join matching a ban added just before it, so every lookup
+        # follows a write to the same banlist
+        samples = []
+        for n in range(options.mutations):
+            mask = f'*!*@fresh{n}.example'
+            cb._db_set(CHANNEL, mask, ['op', time.time(), 'benchmark'])
+            started = time.perf_counter_ns()
+            cb._enforceJoins([(irc, CHANNEL, f'fresh{n}',
+                               f'fresh{n}!~fresh@fresh{n}.example')])
+            samples.append(time.perf_counter_ns() - started)
+        results.append(_latencies('join.afterWrite', size, samples))
+        cb._writer.flush()
+        cb._modes.flush()
+
+        # Paste body of the list command, from a fresh snapshot each time
+        samples = []
+        for n in range(options.repeat):
+            started = time.perf_counter_ns()
+            with cb._get_db() as db:
+                bans = db[CHANNEL].snapshot()
+            cb._formatBanList(CHANNEL, bans)
+            samples.append(time.perf_counter_ns() - started)
+        results.append(_latencies('list.export', size, samples))
+
+        # Removing the bans past banlistExpiry
+        started = time.perf_counter()
+        expired = cb._cleanup(CHANNEL) or []
+        elapsed = time.perf_counter() - started
+        results.append(_throughput('cleanup', size, len(expired), elapsed))
+    finally:
+        cb.die()
+    return results
+
+
+def compare(old, new):
+    """Print how <new> results moved against <old> ones"""
+    before = {(r['benchmark'], r['size']): r for r in old['results']}
+    print(f"{'benchmark':<16}{'size':>9}  {'metric':<11}{'before':>12}"
+          f"{'after':>12}{'change':>9}")
+    for result in new['results']:
+        previous = before.get((result['benchmark'], result['size']))
+        if previous is None:
+            continue
+        for metric in ('p50_us', 'p99_us', 'per_second'):
+            a, b = previous.get(metric), result.get(metric)
+            if not a or not b:
+                continue
+            print(f"{result['benchmark']:<16}{result['size']:>9}  {metric:<11}"
+                  f"{a:>12}{b:>12}{(b - a) / a:>+9.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Blacklist plugin hot paths.')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='comma separated banlist sizes (default: %(default)s)')
+    parser.add_argument('--joins', type=int, default=10000,
+                        help='joins per join benchmark (default: %(default)s)')
+    parser.add_argument('--hit-rate', dest='hitRate', type=float, default=0.02,
+                        help='share of joins that are banned (default: %(default)s)')
+    parser.add_argument('--mutations', type=int, default=100,
+                        help='bans added and removed (default: %(default)s)')
+    parser.add_argument('--expired', type=float, default=0.1,
+                        help='share of bans old enough for cleanup (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='list exports per size (default: %(default)s)')
+    parser.add_argument('--storage', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='write the JSON results here '
+                        'instead of to stdout')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='print the change against an earlier JSON result')
+    options = parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',')]
+
+    tmpdir = tempfile.mkdtemp(prefix='blacklist-bench-')
+    # Registered first so it runs last, after supybot's own exit handlers
+    # are done logging to tmpdir
+    atexit.register(shutil.rmtree, tmpdir, ignore_errors=True)
+    _openRegistry(tmpdir)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from Blacklist import __version__
+    results = []
+    for size in sizes:
+        print(f'Benchmarking {size} bans...', file=sys.stderr)
+        results.extend(run(size, options, tmpdir))
+
+    report = {'plugin_version': __version__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'created': int(time.time()),
+              'options': vars(options),
+              'results': results}
+    output = json.dumps(report, indent=1, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fd:
+            fd.write(output + '\n')
+    elif not options.compare:
+        print(output)
+    if options.compare:
+        with open(options.compare) as fd:
+            compare(json.load(fd), report)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
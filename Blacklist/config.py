@@ -53,17 +53,30 @@ class CurrencyCommand(registry.Integer):
             raise registry.InvalidRegistryValue(f"Number must be between 0 and {max(plugin.Blacklist.banmasks)}.")
         registry.String.setValue(self, num)
 
+class StorageBackend(registry.OnlySomeStrings):
+    """Must be either 'json' or 'sqlite'."""
+    validStrings = ('json', 'sqlite')
+
 Blacklist = conf.registerPlugin('Blacklist')
 
 conf.registerChannelValue(Blacklist, 'maxInlineEntries',
         registry.PositiveInteger(5, """Maximum number of ban entries to display inline before using pastebin."""))
 
+conf.registerChannelValue(Blacklist, 'pageLines',
+        registry.PositiveInteger(3, """Sets the number of lines, each packed with several bans, shown per page of the list command."""))
+
 conf.registerChannelValue(Blacklist, 'enabled',
         registry.Boolean(False, """Set whether to enable database in a channel."""))
 
 conf.registerChannelValue(Blacklist, 'banlistExpiry',
         registry.PositiveInteger(180, """Sets the number of minutes before a ban is removed from the channl's banlist."""))
 
+conf.registerChannelValue(Blacklist, 'banSets',
+        registry.SpaceSeparatedListOfStrings([], """Sets the global ban sets whose masks are banned in the channel as well as its own banlist."""))
+
+conf.registerChannelValue(Blacklist, 'autoCleanup',
+        registry.Boolean(False, """Sets whether bans older than banlistExpiry are removed from the database automatically, as the cleanup command does."""))
+
 conf.registerChannelValue(Blacklist, 'banTimerExpiry',
         registry.PositiveInteger(30, """Sets the numer of minutes before a timed ban expires if none is given."""))
 
@@ -76,4 +89,31 @@ conf.registerChannelValue(Blacklist, 'banReason',
 conf.registerChannelValue(Blacklist, 'addManualBans',
         registry.Boolean(True, """Sets whether to watch for channel bans directly added by users (not using the bot) to the database."""))
 
+conf.registerGlobalValue(Blacklist, 'storage',
+        StorageBackend('json', """Sets how the database is stored: 'json' keeps one JSON file and journal per channel, 'sqlite' uses blacklist.db and imports the JSON data on first use. Takes effect when the plugin is (re)loaded."""))
+
+conf.registerGlobalValue(Blacklist, 'cacheSize',
+        registry.PositiveInteger(100000, """Sets the maximum number of bans kept in memory. Channels are loaded on first use and the least recently used ones are unloaded beyond this."""))
+
+conf.registerGlobalValue(Blacklist, 'modeDelay',
+        registry.PositiveFloat(0.5, """Sets the number of seconds bans, unbans and kicks are held so they can be sent in as few lines as possible."""))
+
+conf.registerGlobalValue(Blacklist, 'joinQueueSize',
+        registry.PositiveInteger(10000, """Sets the maximum number of joins waiting to be checked against the banlists; joins beyond it are not queued, and the channels they were for are checked as a whole once the queue has caught up."""))
+
+conf.registerGlobalValue(Blacklist, 'kickBurst',
+        registry.PositiveInteger(5, """Sets the number of KICK lines sent at once to a channel; more kicks wait for the next round."""))
+
+conf.registerGlobalValue(Blacklist, 'kickInterval',
+        registry.PositiveFloat(2.0, """Sets the number of seconds between two rounds of kicks to a channel."""))
+
+conf.registerGlobalValue(Blacklist, 'writeDelay',
+        registry.PositiveFloat(0.5, """Sets the number of seconds database changes must be quiet before they are written to disk."""))
+
+conf.registerGlobalValue(Blacklist, 'maxWriteDelay',
+        registry.PositiveFloat(5.0, """Sets the maximum number of seconds a database change may wait before it is written to disk."""))
+
+conf.registerGlobalValue(Blacklist, 'metricsInterval',
+        registry.NonNegativeInteger(0, """Sets the number of seconds between two log lines with the counters and latencies of the metrics command; 0 disables them. Takes effect when the plugin is (re)loaded."""))
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
\ No newline at end of file
@@ -2,7 +2,14 @@
 # V1.02 - Improved version with better error handling, thread safety, and security
 ###
 
+import bisect
+import collections
+import csv
+import heapq
+import io
+import itertools
 import json
+import math
 import os
 import time
 import threading
@@ -12,10 +19,13 @@ import string
 import urllib.request
 import urllib.parse
 import logging
+import shutil
+import sqlite3
+from array import array
 from contextlib import contextmanager
 
 from supybot.commands import *
-from supybot import callbacks, conf, ircmsgs, ircutils, schedule
+from supybot import callbacks, conf, ircmsgs, ircutils, schedule, world
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -28,6 +38,1321 @@ except ImportError:
 # Set up logging
 logger = logging.getLogger('supybot.plugins.Blacklist')
 
+
+def _isWild(s):
+    return '*' in s or '?' in s
+
+
+def _globToRegex(pattern):
+    """Translate an IRC glob (already case-folded) into a regex source"""
+    return ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c)
+                   for c in pattern)
+
+
+class MaskIndex(object):
+    """Per-channel match index over a set of banmasks.
+
+    Literal masks are found with a single dict lookup.  Wildcard masks are
+    bucketed by their literal host, their literal ``*suffix`` host or their
+    literal ident, so a hostmask only gets tested against the few masks that
+    can possibly match it.  Whatever is left is compiled into one combined
+    regex, rebuilt lazily after a change.  Masks and hostmasks are folded with
+    ``ircutils.toLower`` so matching agrees with ``hostmaskPatternEqual``.
+
+    Changes replace buckets instead of editing them in place, so ``match``
+    may run without a lock while a single writer changes the index.
+    """
+
+    def __init__(self, masks=()):
+        self._exact = {}       # folded mask -> {mask: None}
+        self._hosts = {}       # folded host -> {mask: None}
+        self._suffixes = {}    # folded host suffix -> {mask: None}
+        self._suffixLengths = {}  # suffix length -> number of buckets
+        self._idents = {}      # folded ident -> {mask: None}
+        self._rest = {}        # mask -> regex source
+        self._where = {}       # mask -> (table, key)
+        self._matchers = {}    # mask -> compiled matcher, built on demand
+        self._combined = None  # (rest, compiled regex, group names) or None
+        for mask in masks:
+            self.add(mask, _shared=False)  # nobody can be reading yet
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, mask):
+        return mask in self._where
+
+    def _classify(self, folded):
+        if not _isWild(folded):
+            return self._exact, folded
+        nick, sep, rest = folded.partition('!')
+        ident, sep2, host = rest.partition('@')
+        if sep and sep2:
+            if not _isWild(host):
+                return self._hosts, host
+            if host[0] == '*' and len(host) > 1 and not _isWild(host[1:]):
+                return self._suffixes, host[1:]
+            if not _isWild(ident):
+                return self._idents, ident
+        return self._rest, None
+
+    def add(self, mask, _shared=True):
+        if mask in self._where:
+            return
+        folded = ircutils.toLower(mask)
+        table, key = self._classify(folded)
+        if table is self._rest:
+            rest = dict(self._rest) if _shared else self._rest
+            rest[mask] = _globToRegex(folded)
+            self._rest = rest
+            table = None
+        else:
+            bucket = table.get(key)
+            if bucket is None:
+                bucket = {}
+                if table is self._suffixes:
+                    n = len(key)
+                    lengths = dict(self._suffixLengths) if _shared \
+                        else self._suffixLengths
+                    lengths[n] = lengths.get(n, 0) + 1
+                    self._suffixLengths = lengths
+            elif _shared:
+                bucket = dict(bucket)
+            bucket[mask] = None
+            table[key] = bucket
+        self._where[mask] = (table, key)  # table None: in _rest
+
+    def discard(self, mask):
+        try:
+            table, key = self._where.pop(mask)
+        except KeyError:
+            return
+        self._matchers.pop(mask, None)
+        if table is None:
+            rest = dict(self._rest)
+            del rest[mask]
+            self._rest = rest
+        else:
+            bucket = dict(table[key])
+            del bucket[mask]
+            if bucket:
+                table[key] = bucket
+            else:
+                del table[key]
+                if table is self._suffixes:
+                    n = len(key)
+                    lengths = dict(self._suffixLengths)
+                    lengths[n] -= 1
+                    if not lengths[n]:
+                        del lengths[n]
+                    self._suffixLengths = lengths
+
+    def _matcher(self, mask):
+        matcher = self._matchers.get(mask)
+        if matcher is None:
+            source = _globToRegex(ircutils.toLower(mask))
+            matcher = self._matchers[mask] = re.compile(
+                source + r'\Z', re.I | re.S).match
+        return matcher
+
+    def _scan(self, bucket, folded):
+        if bucket:
+            for mask in bucket:
+                if self._matcher(mask)(folded) is not None:
+                    return mask
+        return None
+
+    def _combinedMatch(self, folded):
+        rest = self._rest
+        combined = self._combined
+        if combined is None or combined[0] is not rest:
+            names = []
+            parts = []
+            for mask, source in rest.items():
+                names.append(mask)
+                parts.append(f'(?P<m{len(parts)}>{source})')
+            regex = re.compile('(?:%s)\\Z' % '|'.join(parts), re.I | re.S)
+            combined = self._combined = (rest, regex, names)
+        rest, regex, names = combined
+        m = regex.match(folded)
+        if m is None:
+            return None
+        return names[int(m.lastgroup[1:])]
+
+    def match(self, hostmask):
+        """Return one mask matching <hostmask>, or None"""
+        return self.matchFolded(ircutils.toLower(hostmask))
+
+    def matchFolded(self, folded):
+        """Like match, for a hostmask already folded with ircutils.toLower"""
+        exact = self._exact.get(folded)
+        if exact:
+            # Masks differing only in case share the bucket; any one will do
+            return next(iter(exact))
+        nick, _, rest = folded.partition('!')
+        ident, _, host = rest.partition('@')
+        mask = self._scan(self._hosts.get(host), folded)
+        lengths = self._suffixLengths
+        if mask is None and lengths:
+            for n in lengths:
+                if n <= len(host):
+                    mask = self._scan(self._suffixes.get(host[-n:]), folded)
+                    if mask is not None:
+                        break
+        if mask is None:
+            mask = self._scan(self._idents.get(ident), folded)
+        if mask is None and self._rest:
+            mask = self._combinedMatch(folded)
+        return mask
+
+
+class BanJournal(object):
+    """Snapshot plus append-only journal for (part of) the database.
+
+    Every mutation is appended to ``<path>.journal`` as one JSON line and
+    synced to disk, so its cost does not depend on the size of the banlist.
+    Loading reads the snapshot at <path> and replays the journal on top of
+    it.  Once the journal outgrows the live data it is rotated to
+    ``<path>.journal.old`` and folded into a fresh snapshot.
+    """
+
+    minCompactRecords = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.journalPath = path + '.journal'
+        self.rotatedPath = path + '.journal.old'
+        self.records = 0
+        self.live = 0  # approximate number of bans, to pace compaction
+        self._fd = None
+
+    @staticmethod
+    def _apply(db, record):
+        channel, mask = record['c'], record['m']
+        if record['op'] == 'set':
+            db.setdefault(channel, {})[mask] = record['v']
+        else:
+            bans = db.get(channel)
+            if bans is not None:
+                bans.pop(mask, None)
+                if not bans:
+                    del db[channel]
+
+    def _replay(self, path, db):
+        """Apply the records in <path> to <db>, dropping a torn last line"""
+        if not os.path.exists(path):
+            return 0
+        count = good = 0
+        torn = False
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete record')
+                    self._apply(db, json.loads(line))
+                except (ValueError, KeyError):
+                    torn = True
+                    break
+                count += 1
+                good += len(line)
+        if torn:
+            logger.warning(f"Discarding damaged journal tail of {path} at byte {good}")
+            with open(path, 'r+b') as f:
+                f.truncate(good)
+        return count
+
+    def load(self):
+        """Return the database described by the snapshot and journals"""
+        db = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                db = json.load(f)
+        interrupted = os.path.exists(self.rotatedPath)
+        self.records = self._replay(self.rotatedPath, db)
+        self.records += self._replay(self.journalPath, db)
+        self.live = sum(len(bans) for bans in db.values())
+        if interrupted:
+            # A compaction did not finish; fold everything in right away
+            self.rotate()
+            self.compact(db)
+        return db
+
+    def append(self, records):
+        """Durably append <records> to the live journal.  Returns the
+        number of bytes written."""
+        if self._fd is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fd = open(self.journalPath, 'ab')
+        data = b''.join(
+            json.dumps(r, separators=(',', ':')).encode('utf-8') + b'\n'
+            for r in records)
+        self._fd.write(data)
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        self.records += len(records)
+        for record in records:
+            self.live += 1 if record['op'] == 'set' else -1
+        self.live = max(self.live, 0)
+        return len(data)
+
+    def needsCompaction(self):
+        return self.records > max(self.minCompactRecords, self.live)
+
+    def compactNow(self):
+        """Fold the journal into the snapshot, removing the files entirely
+        when nothing is left"""
+        db = self.load()
+        self.rotate()
+        if db:
+            self.compact(db)
+        else:
+            self.remove()
+
+    def rotate(self):
+        """Move the live journal aside so a snapshot can supersede it"""
+        self.close()
+        if os.path.exists(self.journalPath):
+            if os.path.exists(self.rotatedPath):
+                # The previous compaction failed, keep its records too
+                with open(self.journalPath, 'rb') as src, \
+                        open(self.rotatedPath, 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.journalPath)
+            else:
+                os.replace(self.journalPath, self.rotatedPath)
+        self.records = 0
+
+    def compact(self, snapshot):
+        """Write <snapshot> atomically and drop the rotated journal"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_file = f"{self.path}.tmp.{os.getpid()}"
+        with open(temp_file, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.path)
+        try:
+            os.remove(self.rotatedPath)
+        except FileNotFoundError:
+            pass
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.journalPath, self.rotatedPath):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.records = self.live = 0
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
+class ChannelJournalStore(object):
+    """JSON storage for the Blacklist database, one BanJournal per channel.
+
+    Channels are listed from the file names under <directory>, so nothing
+    is parsed until a channel is actually needed.  The old single-file
+    database at <legacyPath> is split into per-channel files the first
+    time the channels are listed.
+    """
+
+    indexed = False
+
+    def __init__(self, directory, legacyPath=None):
+        self.path = directory
+        self.legacyPath = legacyPath
+        self._lock = threading.Lock()
+        self._journals = {}
+
+    def _journal(self, channel):
+        journal = self._journals.get(channel)
+        if journal is None:
+            name = urllib.parse.quote(channel, safe='') + '.json'
+            journal = self._journals[channel] = BanJournal(
+                os.path.join(self.path, name))
+        return journal
+
+    def _migrateLegacy(self):
+        legacy = BanJournal(self.legacyPath)
+        if not (os.path.exists(legacy.path) or
+                os.path.exists(legacy.journalPath)):
+            return
+        db = legacy.load()
+        for channel, bans in db.items():
+            journal = self._journal(channel)
+            journal.rotate()
+            journal.compact({channel: bans})
+        for path in (legacy.path, legacy.journalPath):
+            if os.path.exists(path):
+                os.replace(path, path + '.migrated')
+        logger.info(f"Split {legacy.path} into {len(db)} channel files")
+
+    def channels(self):
+        """Return the channels that have data on disk"""
+        with self._lock:
+            if self.legacyPath:
+                self._migrateLegacy()
+            if not os.path.isdir(self.path):
+                return []
+            channels = set()
+            for name in os.listdir(self.path):
+                base, sep, rest = name.rpartition('.json')
+                if sep and rest in ('', '.journal', '.journal.old'):
+                    channels.add(urllib.parse.unquote(base))
+            return list(channels)
+
+    def loadChannel(self, channel):
+        with self._lock:
+            journal = self._journal(channel)
+            try:
+                db = journal.load()
+            except ValueError as e:
+                logger.error(f"Failed to load {journal.path}: {e}")
+                backup = f"{journal.path}.backup.{int(time.time())}"
+                os.rename(journal.path, backup)
+                logger.warning(f"Backed up corrupted database to {backup}")
+                db = journal.load()
+            return db.get(channel, {})
+
+    def append(self, records):
+        """Append <records> to their channels' journals, compacting the
+        journals that have outgrown their data.  Returns the number of
+        bytes appended."""
+        written = 0
+        with self._lock:
+            batches = {}
+            for record in records:
+                batches.setdefault(record['c'], []).append(record)
+            for channel, batch in batches.items():
+                journal = self._journal(channel)
+                written += journal.append(batch)
+                journal.close()
+                if journal.needsCompaction():
+                    journal.compactNow()
+        return written
+
+    def close(self):
+        with self._lock:
+            for journal in self._journals.values():
+                journal.close()
+
+
+class SqliteStore(object):
+    """SQLite storage for the Blacklist database.
+
+    Bans live in a single ``bans`` table keyed by ``(channel, mask)`` and
+    indexed on ``(channel, timestamp)``, so a flush is one small transaction
+    and expiry and statistics are indexed queries.  On first use whatever
+    the <legacy> store holds is imported once.
+    """
+
+    indexed = True
+    schema = """
+        CREATE TABLE IF NOT EXISTS bans (
+            channel TEXT NOT NULL,
+            mask TEXT NOT NULL,
+            adder TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            reason TEXT NOT NULL,
+            PRIMARY KEY (channel, mask)
+        );
+        CREATE INDEX IF NOT EXISTS bans_timestamp ON bans (channel, timestamp);
+    """
+
+    def __init__(self, path, legacy=None):
+        self.path = path
+        self.legacy = legacy
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript(self.schema)
+            if self.legacy is not None and \
+                    self._conn.execute('PRAGMA user_version').fetchone()[0] == 0:
+                self._importLegacy(self._conn)
+        return self._conn
+
+    def _importLegacy(self, conn):
+        rows = []
+        for channel in self.legacy.channels():
+            rows.extend((channel, mask, adder, timestamp, reason)
+                        for mask, (adder, timestamp, reason)
+                        in self.legacy.loadChannel(channel).items())
+        if rows:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO bans VALUES (?, ?, ?, ?, ?)', rows)
+            logger.info(f"Imported {len(rows)} bans from {self.legacy.path}")
+        conn.execute('PRAGMA user_version = 1')
+
+    def channels(self):
+        """Return the channels that have bans"""
+        with self._lock:
+            return [row[0] for row in self._connect().execute(
+                'SELECT DISTINCT channel FROM bans')]
+
+    def loadChannel(self, channel):
+        with self._lock:
+            return {mask: [adder, timestamp, reason]
+                    for mask, adder, timestamp, reason in self._connect().execute(
+                        'SELECT mask, adder, timestamp, reason FROM bans '
+                        'WHERE channel = ?', (channel,))}
+
+    def append(self, records):
+        """Apply <records> in a single transaction.  Returns the size in
+        bytes of the values handed to SQLite."""
+        written = 0
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for record in records:
+                    if record['op'] == 'set':
+                        row = (record['c'], record['m'], *record['v'])
+                        conn.execute(
+                            'INSERT OR REPLACE INTO bans VALUES (?, ?, ?, ?, ?)',
+                            row)
+                    else:
+                        row = (record['c'], record['m'])
+                        conn.execute(
+                            'DELETE FROM bans WHERE channel = ? AND mask = ?',
+                            row)
+                    written += sum(len(str(value).encode('utf-8'))
+                                   for value in row)
+        return written
+
+    def expire(self, channel, cutoff):
+        """Delete the bans in <channel> older than <cutoff> and return
+        their masks"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                masks = [row[0] for row in conn.execute(
+                    'SELECT mask FROM bans WHERE channel = ? AND timestamp < ?',
+                    (channel, cutoff))]
+                conn.execute(
+                    'DELETE FROM bans WHERE channel = ? AND timestamp < ?',
+                    (channel, cutoff))
+        return masks
+
+    def stats(self, channel):
+        """Return (count, oldest, newest) for <channel>"""
+        with self._lock:
+            return self._connect().execute(
+                'SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM bans '
+                'WHERE channel = ?', (channel,)).fetchone()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class StringTable(object):
+    """Interned, reference-counted strings shared by every BanTable"""
+
+    __slots__ = ('_strings', '_ids', '_refs', '_free')
+
+    def __init__(self):
+        self._strings = []
+        self._ids = {}
+        self._refs = array('I')
+        self._free = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, i):
+        return self._strings[i]
+
+    def intern(self, s):
+        i = self._ids.get(s)
+        if i is None:
+            if self._free:
+                i = self._free.pop()
+                self._strings[i] = s
+            else:
+                i = len(self._strings)
+                self._strings.append(s)
+                self._refs.append(0)
+            self._ids[s] = i
+        self._refs[i] += 1
+        return i
+
+    def release(self, i):
+        self._refs[i] -= 1
+        if not self._refs[i]:
+            del self._ids[self._strings[i]]
+            self._strings[i] = None
+            self._free.append(i)
+
+    def frozen(self):
+        """A copy of the id -> string mapping that later changes (which
+        may reuse ids) cannot affect"""
+        return list(self._strings)
+
+
+class BanSnapshot(object):
+    """Read-only copy of a BanTable, as of one moment.
+
+    Holds its own copies of the rows, columns, strings and aggregates, so
+    it can be read from any thread without a lock while the table it was
+    taken from keeps changing.
+    """
+
+    __slots__ = ('_strings', '_rows', '_adders', '_reasons', '_times',
+                 '_adderCounts', '_dayCounts', '_newest', '_oldest')
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, mask):
+        return mask in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __getitem__(self, mask):
+        row = self._rows[mask]
+        return (self._strings[self._adders[row]], self._times[row],
+                self._strings[self._reasons[row]])
+
+    def get(self, mask, default=None):
+        try:
+            return self[mask]
+        except KeyError:
+            return default
+
+    def oldest(self):
+        """Timestamp of the oldest ban, or None"""
+        return self._oldest
+
+    def newest(self):
+        """Timestamp of the newest ban, or None"""
+        return self._newest
+
+    def topAdders(self, n):
+        """The <n> adders with the most bans, as (adder, count) pairs"""
+        top = heapq.nlargest(n, self._adderCounts.items(),
+                             key=lambda item: item[1])
+        return [(self._strings[adder], count) for adder, count in top]
+
+    def addedSince(self, days, now):
+        """Bans added during the last <days> days, today included"""
+        today = int(now // 86400)
+        return sum(count for day, count in self._dayCounts.items()
+                   if day > today - days)
+
+    def keys(self):
+        return self._rows.keys()
+
+    def items(self):
+        for mask in self._rows:
+            yield mask, self[mask]
+
+    def values(self):
+        for mask in self._rows:
+            yield self[mask]
+
+
+class BanTable(BanSnapshot):
+    """Columnar storage for one channel's bans.
+
+    Looks like a dict of mask -> (adder, timestamp, reason), but adders and
+    reasons are ids into a shared StringTable and timestamps sit in an
+    ``array('d')``, so a ban costs a few machine words instead of a list and
+    its own copies of the strings.  Deleted rows are left as holes and
+    squeezed out once they make up half the table; iteration follows
+    insertion order like a dict.  A heap of (timestamp, mask), built on
+    first use, finds the oldest bans without scanning the table.
+
+    Running aggregates (bans per adder, bans per day of addition, newest
+    timestamp) are updated on every change so statistics never rescan it.
+    """
+
+    __slots__ = ('_byTime',)
+
+    def __init__(self, strings, entries=None):
+        self._strings = strings
+        self._rows = {}  # mask -> row
+        self._adders = array('I')
+        self._reasons = array('I')
+        self._times = array('d')
+        self._byTime = None  # heap of (timestamp, mask), stale entries skipped
+        self._adderCounts = collections.Counter()  # adder id -> bans
+        self._dayCounts = collections.Counter()  # day number -> bans
+        self._newest = None  # None once the newest ban is deleted
+        if entries:
+            for mask, entry in entries.items():
+                self[mask] = entry
+
+    def snapshot(self):
+        """Return a BanSnapshot of the table as it is now"""
+        snap = BanSnapshot()
+        snap._strings = self._strings.frozen()
+        snap._rows = dict(self._rows)
+        snap._adders = self._adders[:]
+        snap._reasons = self._reasons[:]
+        snap._times = self._times[:]
+        snap._adderCounts = self._adderCounts.copy()
+        snap._dayCounts = self._dayCounts.copy()
+        snap._oldest = self.oldest()
+        snap._newest = self.newest()
+        return snap
+
+    def __setitem__(self, mask, entry):
+        adder, timestamp, reason = entry
+        adder = self._strings.intern(adder)
+        reason = self._strings.intern(reason)
+        row = self._rows.get(mask)
+        if row is None:
+            self._rows[mask] = len(self._times)
+            self._adders.append(adder)
+            self._reasons.append(reason)
+            self._times.append(timestamp)
+        else:
+            self._forget(row)
+            self._adders[row] = adder
+            self._reasons[row] = reason
+        self._adderCounts[adder] += 1
+        self._dayCounts[int(timestamp // 86400)] += 1
+        if self._newest is not None and timestamp > self._newest or \
+                len(self._rows) == 1:
+            self._newest = timestamp
+        if row is not None:
+            if self._times[row] == timestamp:
+                return
+            self._times[row] = timestamp
+        if self._byTime is not None:
+            heapq.heappush(self._byTime, (timestamp, mask))
+            if len(self._byTime) > 2 * len(self._rows) + 64:
+                self._byTime = None  # mostly stale, rebuild on next use
+
+    def __delitem__(self, mask):
+        row = self._rows.pop(mask)
+        self._forget(row)
+        holes = len(self._times) - len(self._rows)
+        if holes > 32 and holes * 2 > len(self._times):
+            self._squeeze()
+
+    def _forget(self, row):
+        """Take the entry in <row> out of the strings and aggregates"""
+        adder = self._adders[row]
+        timestamp = self._times[row]
+        self._strings.release(adder)
+        self._strings.release(self._reasons[row])
+        for counts, key in ((self._adderCounts, adder),
+                            (self._dayCounts, int(timestamp // 86400))):
+            counts[key] -= 1
+            if counts[key] <= 0:
+                del counts[key]
+        if timestamp == self._newest:
+            self._newest = None
+
+    def _squeeze(self):
+        adders, reasons, times = array('I'), array('I'), array('d')
+        for mask, row in self._rows.items():
+            self._rows[mask] = len(times)
+            adders.append(self._adders[row])
+            reasons.append(self._reasons[row])
+            times.append(self._times[row])
+        self._adders, self._reasons, self._times = adders, reasons, times
+
+    def _timeIndex(self):
+        heap = self._byTime
+        if heap is None:
+            heap = self._byTime = [(self._times[row], mask)
+                                   for mask, row in self._rows.items()]
+            heapq.heapify(heap)
+        return heap
+
+    def expired(self, cutoff, limit=None):
+        """Pop and return up to <limit> masks added before <cutoff>, oldest
+        first.  They leave the time index, so the caller deletes them."""
+        heap = self._timeIndex()
+        masks = []
+        while heap and heap[0][0] < cutoff and \
+                (limit is None or len(masks) < limit):
+            timestamp, mask = heapq.heappop(heap)
+            row = self._rows.get(mask)
+            if row is not None and self._times[row] == timestamp:
+                masks.append(mask)
+        return masks
+
+    def oldest(self):
+        """Timestamp of the oldest ban, or None"""
+        heap = self._timeIndex()
+        while heap:
+            timestamp, mask = heap[0]
+            row = self._rows.get(mask)
+            if row is not None and self._times[row] == timestamp:
+                return timestamp
+            heapq.heappop(heap)
+        return None
+
+    def newest(self):
+        """Timestamp of the newest ban, or None.  Only rescans the table
+        right after the newest ban was deleted."""
+        if self._newest is None and self._rows:
+            self._newest = max(self._times[row] for row in self._rows.values())
+        return self._newest
+
+
+class ChannelCache(object):
+    """Lazily loaded, size-bounded mapping of channel -> {mask: entry}.
+
+    Only the channel names are known up front.  A channel's bans are read
+    through <loader> on first access, and the least recently used channels
+    are unloaded (calling <onEvict> with the channel and its bans) once
+    more than <budget> bans are
+    resident.  Membership tests never load anything.
+    """
+
+    def __init__(self, loader, channels, budget, onEvict=None):
+        self._loader = loader
+        self._known = set(channels)
+        self._loaded = collections.OrderedDict()
+        self.budget = budget
+        self._onEvict = onEvict
+
+    def __contains__(self, channel):
+        return channel in self._known
+
+    def __iter__(self):
+        return iter(list(self._known))
+
+    def __len__(self):
+        return len(self._known)
+
+    def __getitem__(self, channel):
+        bans = self._loaded.get(channel)
+        if bans is not None:
+            self._loaded.move_to_end(channel)
+            return bans
+        if channel not in self._known:
+            raise KeyError(channel)
+        bans = self._loader(channel)
+        if not bans:
+            self._known.discard(channel)
+            raise KeyError(channel)
+        self._loaded[channel] = bans
+        self._evict()
+        return bans
+
+    def get(self, channel, default=None):
+        try:
+            return self[channel]
+        except KeyError:
+            return default
+
+    def setdefault(self, channel, default):
+        try:
+            return self[channel]
+        except KeyError:
+            self._known.add(channel)
+            self._loaded[channel] = default
+            return default
+
+    def __delitem__(self, channel):
+        self._known.discard(channel)
+        self._loaded.pop(channel, None)
+
+    def loaded(self):
+        return list(self._loaded)
+    
+    def unload(self, channel):
+        """Drop the bans of <channel> from memory; it stays known"""
+        bans = self._loaded.pop(channel, None)
+        if bans is not None and self._onEvict is not None:
+            self._onEvict(channel, bans)
+
+    def peek(self, channel):
+        """The loaded bans of <channel>, or None; never loads or reorders"""
+        return self._loaded.get(channel)
+
+    def _evict(self):
+        size = sum(len(bans) for bans in self._loaded.values())
+        while size > self.budget and len(self._loaded) > 1:
+            channel, bans = self._loaded.popitem(last=False)
+            size -= len(bans)
+            if self._onEvict is not None:
+                self._onEvict(channel, bans)
+
+
+class ExpiryQueue(object):
+    """Min-heap of pending unban and expiry events.
+
+    Events are keyed by ``(kind, network, channel, mask)``; scheduling a key
+    again or cancelling it leaves the old heap entry behind, and stale
+    entries are skipped when popped.  The heap is rebuilt once stale entries
+    outnumber live ones.
+    """
+
+    def __init__(self, events=()):
+        self._due = dict(events)  # key -> when
+        self._rebuild()
+
+    def __len__(self):
+        return len(self._due)
+
+    def _rebuild(self):
+        self._heap = [(when, key) for key, when in self._due.items()]
+        heapq.heapify(self._heap)
+
+    def schedule(self, key, when):
+        self._due[key] = when
+        heapq.heappush(self._heap, (when, key))
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._rebuild()
+
+    def cancel(self, key):
+        return self._due.pop(key, None) is not None
+
+    def popDue(self, now):
+        """Remove and return the (key, when) pairs due at <now>"""
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            when, key = heapq.heappop(heap)
+            if self._due.get(key) == when:
+                del self._due[key]
+                due.append((key, when))
+        return due
+
+    def items(self):
+        return list(self._due.items())
+
+
+class ModeBatcher(object):
+    """Per-channel queue of outgoing ban changes and kicks.
+
+    Queued changes are held for <delay> seconds and then sent packed: as
+    many ``+b``/``-b`` per MODE line as the server's ISUPPORT ``MODES``
+    allows, then KICKs grouped by reason up to its ``TARGMAX`` for KICK.
+    Bans always leave before the kicks queued alongside them.  At most
+    <kickBurst> KICK lines leave per channel every <kickInterval> seconds;
+    the rest wait in the queue for the next round.
+    """
+
+    lineBudget = 450  # bytes of arguments per line, leaving room for prefixes
+
+    def __init__(self, delay, kickBurst=None, kickInterval=None):
+        self.delay = delay
+        self.kickBurst = kickBurst
+        self.kickInterval = kickInterval or delay
+        self._lock = threading.Lock()
+        # (network, channel) -> [irc, channel, {(mode, mask): None},
+        #                        {reason: [nick, ...]}]
+        self._queues = {}
+
+    def _queue(self, irc, channel, delay=None):
+        key = (irc.network, channel)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = [irc, channel, {}, {}]
+            schedule.addEvent(self.flush, time.time() + (delay or self.delay),
+                              args=(key,))
+        return queue
+
+    def ban(self, irc, channel, mask):
+        with self._lock:
+            self._queue(irc, channel)[2][('+b', mask)] = None
+
+    def unban(self, irc, channel, mask):
+        with self._lock:
+            self._queue(irc, channel)[2][('-b', mask)] = None
+
+    def kick(self, irc, channel, nick, reason):
+        with self._lock:
+            nicks = self._queue(irc, channel)[3].setdefault(reason, [])
+            if nick not in nicks:
+                nicks.append(nick)
+
+    @staticmethod
+    def kickTargets(irc):
+        """Number of nicks the server accepts in one KICK"""
+        for item in (irc.state.supported.get('targmax') or '').split(','):
+            name, _, limit = item.partition(':')
+            if name.upper() == 'KICK':
+                return int(limit) if limit.isdigit() else 4
+        return 1
+
+    def _pack(self, items, limit, overhead):
+        batch = []
+        length = overhead
+        for item, size in items:
+            if batch and (len(batch) >= limit or
+                          length + size > self.lineBudget):
+                yield batch
+                batch = []
+                length = overhead
+            batch.append(item)
+            length += size
+        if batch:
+            yield batch
+
+    def messages(self, irc, channel, modes, kicks):
+        """Pack queued changes into as few lines as the server allows.
+        Yields (message, reason, nicks); reason and nicks are None for
+        MODE lines."""
+        per_line = irc.state.supported.get('modes') or 3
+        for batch in self._pack(((m, len(m[1]) + 2) for m in modes),
+                                per_line, len(channel) + 8):
+            yield ircmsgs.modes(channel, batch), None, None
+        targets = self.kickTargets(irc)
+        for reason, nicks in kicks.items():
+            for batch in self._pack(((n, len(n) + 1) for n in nicks),
+                                    targets, len(channel) + len(reason) + 8):
+                yield ircmsgs.kicks(channel, batch, reason), reason, batch
+
+    def flush(self, key=None):
+        """Send the changes queued for <key>, or everything queued for
+        every channel regardless of the kick rate"""
+        with self._lock:
+            if key is None:
+                queues = list(self._queues.values())
+                self._queues.clear()
+            else:
+                queue = self._queues.pop(key, None)
+                queues = [queue] if queue else []
+        for irc, channel, modes, kicks in queues:
+            burst = self.kickBurst if key is not None else None
+            for msg, reason, nicks in self.messages(irc, channel, modes, kicks):
+                if nicks is not None and burst is not None:
+                    if burst <= 0:
+                        self._defer(irc, channel, reason, nicks)
+                        continue
+                    burst -= 1
+                irc.queueMsg(msg)
+
+    def _defer(self, irc, channel, reason, nicks):
+        """Put <nicks> back in the queue for the next round.  The reason is
+        carried along rather than read back from the KICK, which has no
+        reason argument when it is empty."""
+        with self._lock:
+            queue = self._queue(irc, channel, self.kickInterval)
+            queued = queue[3].setdefault(reason, [])
+            for nick in nicks:
+                if nick not in queued:
+                    queued.append(nick)
+
+
+class CoalescingWriter(object):
+    """One long-lived thread that runs <flush> once per burst of changes.
+
+    ``mark()`` only sets a dirty flag.  The thread flushes once the burst has
+    been quiet for <debounce> seconds, and never later than <maxDelay>
+    seconds after the first unflushed change.  ``stop()`` flushes
+    synchronously so nothing is lost on unload.
+    """
+
+    def __init__(self, flush, debounce, maxDelay, name='Blacklist writer'):
+        self._flush = flush
+        self.debounce = debounce
+        self.maxDelay = maxDelay
+        self._cond = threading.Condition()
+        self._flushLock = threading.Lock()
+        self._dirtySince = None
+        self._lastMark = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name,
+                                        daemon=True)
+        self._thread.start()
+
+    def mark(self):
+        with self._cond:
+            now = time.monotonic()
+            if self._dirtySince is None:
+                self._dirtySince = now
+                self._cond.notify()
+            self._lastMark = now
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._dirtySince is None:
+                        # Idle, or flush() got there first
+                        self._cond.wait()
+                        continue
+                    deadline = min(self._lastMark + self.debounce,
+                                   self._dirtySince + self.maxDelay)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopped:
+                    return
+                self._dirtySince = None
+            try:
+                with self._flushLock:
+                    self._flush()
+            except Exception as e:
+                logger.error(f"Database flush failed: {e}")
+
+    def flush(self):
+        """Flush right away from the calling thread"""
+        with self._cond:
+            self._dirtySince = None
+        with self._flushLock:
+            self._flush()
+
+    def stop(self):
+        """Stop the thread and flush whatever is still pending"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        with self._flushLock:
+            self._flush()
+
+
+class Histogram(object):
+    """Durations counted in power-of-two microsecond buckets, so recording
+    one is a few integer operations and the memory never grows"""
+
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 32  # bucket i holds durations below 2**i us
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[min(int(seconds * 1e6).bit_length(), 31)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, share):
+        """Upper bound in seconds of the bucket holding the <share>
+        quantile, never above the largest duration seen"""
+        rank = share * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def copy(self):
+        other = Histogram()
+        other.buckets = self.buckets[:]
+        other.count, other.total, other.max = self.count, self.total, self.max
+        return other
+
+
+class Metrics(object):
+    """Counters and duration histograms of the plugin's hot paths.
+
+    Recording takes one short, uncontended lock; ``snapshot()`` copies
+    everything so reports are built outside of it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._histograms = collections.defaultdict(Histogram)
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._histograms[name].add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        """Return ({name: count}, {name: Histogram}) as they are now"""
+        with self._lock:
+            return (collections.Counter(self._counters),
+                    {name: h.copy() for name, h in self._histograms.items()})
+
+
+class JoinQueue(object):
+    """Bounded queue of joins waiting to be checked against the banlists.
+
+    ``put()`` only appends, so the IRC read loop never waits on the
+    database.  A worker thread takes up to <batchSize> joins at a time and
+    hands them to <process> as one batch.  Once <maxsize> joins are waiting,
+    new ones are dropped and counted; <onIdle> is called from the worker
+    whenever a batch leaves the queue empty, so whoever dropped them can
+    catch up.  Depth and lag (how long the oldest join of a batch waited)
+    are tracked for the metrics.
+    """
+
+    batchSize = 500
+
+    def __init__(self, process, maxsize, name='Blacklist joins', onIdle=None):
+        self._process = process
+        self._onIdle = onIdle
+        self.maxsize = maxsize
+        self._items = collections.deque()  # (queued at, item)
+        self._cond = threading.Condition()
+        self._busy = False
+        self._stopped = False
+        self.processed = 0
+        self.dropped = 0
+        self.maxDepth = 0
+        self.lag = 0.0
+        self.maxLag = 0.0
+        self._thread = threading.Thread(target=self._run, name=name,
+                                        daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """Queue <item>; returns False if the queue is full"""
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self._items.append((time.monotonic(), item))
+            if len(self._items) > self.maxDepth:
+                self.maxDepth = len(self._items)
+            self._cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                batch = [self._items.popleft() for i in
+                         range(min(len(self._items), self.batchSize))]
+                self._busy = True
+            self.lag = time.monotonic() - batch[0][0]
+            self.maxLag = max(self.maxLag, self.lag)
+            try:
+                self._process([item for queued, item in batch])
+                if self._onIdle is not None and not self._items:
+                    self._onIdle()
+            except Exception as e:
+                logger.error(f"Join enforcement failed: {e}")
+            with self._cond:
+                self._busy = False
+                self.processed += len(batch)
+                self._cond.notify_all()
+
+    def drain(self, timeout=None):
+        """Wait until every queued join has been processed"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._items and not self._busy, timeout)
+
+    def stop(self):
+        """Stop the worker; joins still queued are dropped"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def metrics(self):
+        return {'depth': len(self._items), 'maxDepth': self.maxDepth,
+                'processed': self.processed, 'dropped': self.dropped,
+                'lag': self.lag, 'maxLag': self.maxLag}
+
+
+class MaskBuilder(object):
+    """Turns hostmasks into banmasks following numbered templates.
+
+    Each template (see ``Blacklist.banmasks``) is compiled once into a
+    format string over ``nick``, ``ident``, ``host`` and ``phost`` (the
+    host without its first label), and results are memoised per
+    ``(hostmask, number)`` in a small LRU.
+    """
+
+    _fields = re.compile(r'phost|nick|ident|host')
+
+    def __init__(self, templates, default=2, size=4096):
+        self._formats = {num: self._fields.sub(r'{\g<0>}', template)
+                         for num, template in templates.items()}
+        self.default = default
+        self.size = size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def build(self, hostmask, num):
+        key = (hostmask, num)
+        with self._lock:
+            mask = self._cache.get(key)
+            if mask is not None:
+                self._cache.move_to_end(key)
+                return mask
+        if not ircutils.isUserHostmask(hostmask):
+            raise ValueError("Invalid hostmask components")
+        nick, ident, host = ircutils.splitHostmask(hostmask)
+        phost = host.split('.', 1)[1] if '.' in host else host
+        template = self._formats.get(num, self._formats[self.default])
+        mask = template.format(nick=nick, ident=ident, host=host, phost=phost)
+        with self._lock:
+            self._cache[key] = mask
+            if len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return mask
+
+
+class ListCursor(object):
+    """Where an op's walk through a ban list stopped.
+
+    Holds the generator of packed lines so the next page continues from
+    it, as long as the table, its version and the filters are unchanged.
+    """
+    __slots__ = ('table', 'version', 'filters', 'lines', 'page', 'peeked')
+
+    def __init__(self, table, version, filters, lines):
+        self.table = table
+        self.version = version
+        self.filters = filters
+        self.lines = lines
+        self.page = 0  # last page handed out
+        self.peeked = None
+
+    def resumes(self, table, version, filters, page):
+        return (table is self.table and version == self.version and
+                filters == self.filters and page == self.page + 1)
+
+    def take(self, page, size):
+        """Return the lines of <page>, skipping what lies before it"""
+        if page != self.page + 1:
+            skip = (page - self.page - 1) * size
+            collections.deque(itertools.islice(self.lines, skip), maxlen=0)
+        shown = []
+        if self.peeked is not None:
+            shown.append(self.peeked)
+            self.peeked = None
+        shown.extend(itertools.islice(self.lines, size - len(shown)))
+        self.page = page
+        return shown
+
+    def more(self):
+        if self.peeked is None:
+            self.peeked = next(self.lines, None)
+        return self.peeked is not None
+
+
 class Blacklist(callbacks.Plugin):
     """A custom ban tracking plugin to keep a channel's banlist cleaner"""
     
@@ -46,55 +1371,397 @@ class Blacklist(callbacks.Plugin):
     }
     
     threaded = True
+    expiryTick = 1  # seconds between two runs of the expiry queue
+    unbanRetry = 60  # seconds to wait for a network or channel to come back
+    sweepInterval = 60  # seconds between two automatic cleanup sweeps
+    sweepBudget = 500  # bans an automatic sweep may remove per run
+    sweepLoads = 10  # unloaded channels an automatic sweep may load per run
+    statsTopAdders = 3  # adders named by the stats command
+    statsWindows = (1, 7, 30)  # days the stats command counts new bans over
+    setPrefix = '@'  # ban sets are stored like channels, under '@<name>'
+    pasteApiUrl = 'https://api.pastes.io/v1/pastes'
+    pasteFallbackUrl = 'https://dpaste.com/api/v2/'
+    pasteCacheTime = 86400  # reuse an export for a day; pastes live a week
+    listLineBudget = 400  # bytes of ban entries packed into one reply
+    listCursors = 100  # paging cursors kept, least recently used dropped
+    _maskPattern = re.compile(r'^[^!@]+![^@]+@.+$')
     
     def __init__(self, irc):
         super().__init__(irc)  # Python 3 style super()
-        self.dbfile = os.path.join(str(conf.supybot.directories.data), 'Blacklist', 'blacklist.json')
+        datadir = os.path.join(str(conf.supybot.directories.data), 'Blacklist')
+        self.dbfile = os.path.join(datadir, 'blacklist.json')
         self._db_lock = threading.RLock()
         self.db = {}
+        self._indexes = {}  # channel -> MaskIndex, built on first join
+        self._strings = StringTable()  # adders and reasons, shared by all channels
+        self._store = ChannelJournalStore(os.path.join(datadir, 'channels'),
+                                          legacyPath=self.dbfile)
+        if self.registryValue('storage') == 'sqlite':
+            self._store = SqliteStore(os.path.join(datadir, 'blacklist.db'),
+                                      legacy=self._store)
+        self._pending = []  # journal records not yet written
+        self._inflight = []  # records the writer is storing right now
+        self._versions = {}  # channel -> change counter, bumped on every edit
+        self._pastes = {}  # channel -> (version, url, created) of the last export
+        self._exports = {}  # channel -> ircs waiting on a running export
+        self._cursors = collections.OrderedDict()  # (network, channel, nick) -> ListCursor
+        self._setMatchers = {}  # set key -> MaskIndex, for subscribed sets
+        self._views = {}  # channel -> (version, BanSnapshot), read without a lock
+        self._oldest = {}  # unloaded channel -> its oldest ban, for the sweep
+        self._depth = 0  # nesting of _get_db blocks in the owning thread
+        self._list_lock = threading.Lock()  # paste exports and list cursors
+        self._metrics = Metrics()
         self._initdb()
+        self.timerfile = os.path.join(os.path.dirname(self.dbfile), 'timers.json')
+        self._timer_lock = threading.Lock()
+        self._timersDirty = False
+        self._expiries = ExpiryQueue(self._loadTimers())
+        schedule.addPeriodicEvent(self._expiryTick, self.expiryTick,
+                                  name='bl_expiry_tick', now=False)
+        self._sweepFrom = None  # channel the last sweep stopped at
+        schedule.addPeriodicEvent(self._expirySweep, self.sweepInterval,
+                                  name='bl_expiry_sweep', now=False)
+        self._masks = MaskBuilder(self.banmasks)
+        self._modes = ModeBatcher(self.registryValue('modeDelay'),
+                                  self.registryValue('kickBurst'),
+                                  self.registryValue('kickInterval'))
+        self._members = {}  # (network, channel) -> {nick: (nick, hostmask)}
+        self._overflow = {}  # (network, channel) -> (irc, channel) with dropped joins
+        self._joins = JoinQueue(self._enforceJoins,
+                                self.registryValue('joinQueueSize'),
+                                onIdle=self._enforceOverflow)
+        self._writer = CoalescingWriter(self._flushDb,
+                                        self.registryValue('writeDelay'),
+                                        self.registryValue('maxWriteDelay'))
+        interval = self.registryValue('metricsInterval')
+        if interval:
+            schedule.addPeriodicEvent(self._logMetrics, interval,
+                                      name='bl_metrics', now=False)
     
     def _initdb(self):
         """Initialize database with proper error handling"""
         try:
-            if os.path.exists(self.dbfile):
-                with open(self.dbfile, 'r') as f:
-                    self.db = json.load(f)
-                logger.info(f"Loaded blacklist database with {sum(len(channel_bans) for channel_bans in self.db.values())} total bans")
-            else:
-                self.db = {}
-                self._dbWrite()
-        except (IOError, json.JSONDecodeError) as e:
+            channels = self._store.channels()
+            logger.info(f"Found blacklist database with bans for {len(channels)} channels")
+        except (IOError, json.JSONDecodeError, sqlite3.DatabaseError) as e:
             logger.error(f"Failed to load blacklist database: {e}")
-            self.db = {}
+            channels = []
+            self._store.close()
             # Create backup of corrupted file
-            if os.path.exists(self.dbfile):
-                backup = f"{self.dbfile}.backup.{int(time.time())}"
-                os.rename(self.dbfile, backup)
+            damaged = self._store.path if os.path.isfile(self._store.path) else self.dbfile
+            if os.path.exists(damaged):
+                backup = f"{damaged}.backup.{int(time.time())}"
+                os.rename(damaged, backup)
                 logger.warning(f"Backed up corrupted database to {backup}")
+        self.db = ChannelCache(self._loadChannel, channels,
+                               self.registryValue('cacheSize'),
+                               onEvict=self._evictChannel)
+    
+    def _loadChannel(self, channel):
+        """Read one channel's bans, including changes not yet on disk.
+        Called by the cache with _db_lock held."""
+        self._oldest.pop(channel, None)
+        try:
+            db = {channel: self._store.loadChannel(channel)}
+        except Exception as e:
+            logger.error(f"Failed to load bans for {channel}: {e}")
+            db = {channel: {}}
+        for record in self._inflight + self._pending:
+            if record['c'] == channel:
+                BanJournal._apply(db, record)
+        return BanTable(self._strings, db.get(channel))
+    
+    def _evictChannel(self, channel, bans):
+        self._indexes.pop(channel, None)
+        self._views.pop(channel, None)
+        if not self._store.indexed:
+            # Lets the sweep skip the channel until something in it is due
+            self._oldest[channel] = bans.oldest()
+        logger.debug(f"Unloaded bans for {channel}")
+    
+    def die(self):
+        for name in ('bl_expiry_tick', 'bl_expiry_sweep', 'bl_metrics'):
+            try:
+                schedule.removePeriodicEvent(name)
+            except KeyError:
+                pass
+        self._joins.stop()
+        self._modes.flush()
+        self._writer.stop()
+        self._store.close()
+        super().die()
     
     @contextmanager
     def _get_db(self):
         """Thread-safe context manager for database access"""
+        started = time.perf_counter()
         with self._db_lock:
-            yield self.db
+            if not self._depth:
+                self._metrics.record('lockWait', time.perf_counter() - started)
+            self._depth += 1
+            try:
+                yield self.db
+            finally:
+                self._depth -= 1
+    
+    def _view(self, channel):
+        """Return (version, BanSnapshot) for <channel>, or (0, None) if it
+        has no bans.  While the channel's version is unchanged this takes
+        no lock, so readers do not wait behind writers.  A write only bumps
+        the version; the first read after it copies the whole table under
+        _db_lock, which is O(n) and stalls everything else waiting on the
+        lock.  Paths that need one row, like join lookups, should not come
+        through here."""
+        view = self._views.get(channel)
+        if view is not None and view[0] == self._versions.get(channel, 0):
+            return view
+        if view is None and channel not in self.db:
+            return (0, None)
+        with self._get_db() as db:
+            # The version is bumped inside the write, so once we hold the
+            # lock the table matches it and no half-done change is seen
+            version = self._versions.get(channel, 0)
+            view = self._views.get(channel)
+            if view is None or view[0] != version:
+                bans = db.get(channel)
+                if bans:
+                    view = self._views[channel] = (version, bans.snapshot())
+                else:
+                    self._views.pop(channel, None)
+                    view = None
+        return view or (0, None)
+    
+    def _get_index(self, channel):
+        """Return the match index for a channel, building it on first use.
+        Callers must hold _db_lock."""
+        index = self._indexes.get(channel)
+        if index is None:
+            index = self._indexes[channel] = MaskIndex(self.db.get(channel, ()))
+        return index
+    
+    def _setKey(self, name):
+        return self.setPrefix + name.lower()
+    
+    def _isSet(self, key):
+        return key.startswith(self.setPrefix)
+    
+    def _subscribedSets(self, channel):
+        """Storage keys of the ban sets <channel> subscribes to, sorted"""
+        return tuple(sorted({self._setKey(name) for name in
+                             self.registryValue('banSets', channel)}))
+    
+    def _setMatcher(self, key):
+        """Return the MaskIndex of the ban set <key>, shared by every
+        channel subscribed to it and kept up to date as it changes"""
+        matcher = self._setMatchers.get(key)
+        if matcher is None:
+            with self._get_db() as db:
+                matcher = self._setMatchers.get(key)
+                if matcher is None:
+                    matcher = self._setMatchers[key] = MaskIndex(
+                        db.get(key, ()))
+        return matcher
+    
+    def _pruneSetMatchers(self):
+        """Drop the matchers of ban sets no channel subscribes to any more"""
+        group = conf.supybot.plugins.Blacklist.banSets
+        names = set(group())
+        for name, value in group.getValues(getChildren=True):
+            names.update(value())
+        keys = {self._setKey(name) for name in names}
+        with self._get_db():
+            for key in list(self._setMatchers):
+                if key not in keys:
+                    del self._setMatchers[key]
+    
+    def _matchers(self, channel):
+        """The indexes a member of <channel> is checked against: its own
+        banlist, then its subscribed sets.  Only takes the lock to build
+        an index the first time."""
+        matchers = []
+        if channel in self.db:
+            index = self._indexes.get(channel)
+            if index is None:
+                with self._get_db():
+                    index = self._get_index(channel)
+            matchers.append(index)
+        for key in self._subscribedSets(channel):
+            matchers.append(self._setMatcher(key))
+        return matchers
+    
+    def _lookupBan(self, channel, mask):
+        """Return the entry of <mask> from <channel> or from the first of
+        its subscribed sets holding it.  Reads the snapshots while they are
+        current; once any of them is stale, reads the row from the tables
+        under a short lock rather than taking new snapshots."""
+        keys = (channel,) + self._subscribedSets(channel)
+        views = []
+        for key in keys:
+            view = self._views.get(key)
+            if view is not None and view[0] == self._versions.get(key, 0):
+                views.append(view[1])
+            elif view is not None or key in self.db:
+                break
+        else:
+            for bans in views:
+                if mask in bans:
+                    return bans[mask]
+            return None
+        with self._get_db() as db:
+            for key in keys:
+                bans = db.get(key)
+                if bans is not None and mask in bans:
+                    return bans[mask]
+        return None
+    
+    def _db_set(self, channel, mask, entry):
+        """Store a ban entry and keep the match index in sync"""
+        self._db_setMany(channel, [(mask, entry)])
+    
+    def _db_setMany(self, channel, entries):
+        """Store a list of (mask, entry) pairs under one lock hold, as a
+        single change of the banlist.  Returns how many were stored."""
+        if not entries:
+            return 0
+        with self._get_db() as db:
+            bans = db.get(channel)
+            if bans is None:
+                bans = db.setdefault(channel, BanTable(self._strings))
+            index = self._indexes.get(channel)
+            shared = self._setMatchers.get(channel)
+            for mask, entry in entries:
+                bans[mask] = entry
+                self._pending.append({'op': 'set', 'c': channel, 'm': mask, 'v': entry})
+                if index is not None:
+                    index.add(mask)
+                if shared is not None:
+                    shared.add(mask)
+            self._versions[channel] = self._versions.get(channel, 0) + 1
+        return len(entries)
+    
+    def _db_del(self, channel, mask, journal=True):
+        """Drop a ban entry and keep the match index in sync.  Pass
+        journal=False when the store has already deleted it."""
+        with self._get_db() as db:
+            del db[channel][mask]
+            if journal:
+                self._pending.append({'op': 'del', 'c': channel, 'm': mask})
+            self._versions[channel] = self._versions.get(channel, 0) + 1
+            if not db[channel]:  # Remove empty channel
+                del db[channel]
+                self._indexes.pop(channel, None)
+            elif channel in self._indexes:
+                self._indexes[channel].discard(mask)
+            shared = self._setMatchers.get(channel)
+            if shared is not None:
+                shared.discard(mask)
     
     def _dbWrite(self):
-        """Thread-safe database write with atomic file operation"""
-        def write_thread():
+        """Mark the database dirty; the writer thread coalesces bursts of
+        changes into a single flush"""
+        self._metrics.count('changes')
+        self._writer.mark()
+    
+    def _flushDb(self):
+        """Hand pending mutations to the store and save pending timers.
+        Only the writer thread (or die(), after stopping it) calls this."""
+        with self._db_lock:
+            pending, self._pending = self._pending, []
+            self._inflight = pending
+        if pending:
+            try:
+                started = time.perf_counter()
+                written = self._store.append(pending)
+                self._metrics.record('write', time.perf_counter() - started)
+                self._metrics.count('writes')
+                self._metrics.count('writeBytes', written)
+                logger.debug(f"Stored {len(pending)} database changes")
+            except Exception as e:
+                logger.error(f"Failed to write database changes: {e}")
+                # Keep them for the next flush
+                with self._db_lock:
+                    self._pending = pending + self._pending
             with self._db_lock:
-                try:
-                    os.makedirs(os.path.dirname(self.dbfile), exist_ok=True)
-                    # Write to temporary file first, then rename (atomic operation)
-                    temp_file = f"{self.dbfile}.tmp.{os.getpid()}"
-                    with open(temp_file, 'w') as f:
-                        json.dump(self.db, f, indent=2)  # Pretty print
-                    os.replace(temp_file, self.dbfile)  # Atomic replace
-                    logger.debug("Database written successfully")
-                except Exception as e:
-                    logger.error(f"Failed to write database: {e}")
-        
-        threading.Thread(target=write_thread, daemon=True).start()
+                self._inflight = []
+        
+        with self._timer_lock:
+            timers = self._expiries.items() if self._timersDirty else None
+            self._timersDirty = False
+        if timers is not None:
+            try:
+                self._writeTimers(timers)
+            except Exception as e:
+                logger.error(f"Failed to write pending timers: {e}")
+    
+    def _loadTimers(self):
+        """Read the unban and expiry events saved by the last run"""
+        try:
+            with open(self.timerfile, 'r') as f:
+                return [((kind, network, channel, mask), when)
+                        for kind, network, channel, mask, when in json.load(f)]
+        except FileNotFoundError:
+            return []
+        except (IOError, ValueError) as e:
+            logger.error(f"Failed to load pending timers: {e}")
+            return []
+    
+    def _writeTimers(self, timers):
+        os.makedirs(os.path.dirname(self.timerfile), exist_ok=True)
+        temp_file = f"{self.timerfile}.tmp.{os.getpid()}"
+        with open(temp_file, 'w') as f:
+            json.dump([list(key) + [when] for key, when in timers], f)
+        os.replace(temp_file, self.timerfile)
+    
+    def _scheduleExpiry(self, kind, irc, channel, mask, delay):
+        """Queue an 'unban' (channel mode) or 'expire' (database) event"""
+        with self._timer_lock:
+            self._expiries.schedule((kind, irc.network, channel, mask),
+                                    time.time() + delay)
+            self._timersDirty = True
+        self._dbWrite()
+    
+    def _cancelExpiry(self, kind, irc, channel, mask):
+        with self._timer_lock:
+            if self._expiries.cancel((kind, irc.network, channel, mask)):
+                self._timersDirty = True
+    
+    def _expiryTick(self):
+        """Run every event that is due, grouping unbans per channel"""
+        now = time.time()
+        with self._timer_lock:
+            due = self._expiries.popDue(now)
+            if not due:
+                return
+            self._timersDirty = True
+        
+        unbans = {}
+        with self._get_db():
+            for (kind, network, channel, mask), when in due:
+                if kind == 'expire':
+                    self._remove_from_db(channel, mask)
+                else:
+                    unbans.setdefault((network, channel), []).append((mask, when))
+        
+        for (network, channel), events in unbans.items():
+            irc = world.getIrc(network)
+            if (irc is None or channel not in irc.state.channels or
+                    not irc.state.channels[channel].isHalfopPlus(irc.nick)):
+                # Not connected or no powers yet: try again later, but give
+                # up on events that are more than a day overdue
+                with self._timer_lock:
+                    for mask, when in events:
+                        if now - when < 86400:
+                            self._expiries.schedule(
+                                ('unban', network, channel, mask),
+                                now + self.unbanRetry)
+                continue
+            self._queueUnbans(irc, channel, [mask for mask, when in events])
+        self._dbWrite()
+    
+    def _queueUnbans(self, irc, channel, masks):
+        """Queue -b for <masks>; the mode batcher packs them into lines"""
+        for mask in masks:
+            self._modes.unban(irc, channel, mask)
     
     def _validate_mask(self, mask):
         """Validate hostmask format"""
@@ -102,8 +1769,7 @@ class Blacklist(callbacks.Plugin):
             return False
         
         # Basic hostmask pattern validation
-        pattern = r'^[^!@]+![^@]+@.+$'
-        return re.match(pattern, mask) is not None
+        return self._maskPattern.match(mask) is not None
     
     def _elapsed(self, inp):
         """Convert timestamp to human-readable time elapsed"""
@@ -126,44 +1792,7 @@ class Blacklist(callbacks.Plugin):
     def _createMask(self, irc, target, num):
         """Create ban mask with validation"""
         try:
-            nick, ident, host = ircutils.splitHostmask(irc.state.nickToHostmask(target))
-            
-            # Validate components
-            if not all([nick, ident, host]):
-                raise ValueError("Invalid hostmask components")
-            
-            mask_template = self.banmasks.get(num, self.banmasks[2])
-            
-            # Create the mask - only escape nick and host, not ident
-            mask = mask_template.replace("nick", re.escape(nick)) \
-                            .replace("ident", ident) \
-                            .replace("host", re.escape(host)) \
-                            .replace("phost", re.escape(host.split(".", 1)[1]) if "." in host else re.escape(host))
-            
-            if not self._validate_mask(mask):
-                raise ValueError("Generated invalid mask")
-    
-    def _createMask(self, irc, target, num):
-        """Create ban mask with validation"""
-        try:
-            nick, ident, host = ircutils.splitHostmask(irc.state.nickToHostmask(target))
-            
-            # Validate components
-            if not all([nick, ident, host]):
-                raise ValueError("Invalid hostmask components")
-            
-            mask_template = self.banmasks.get(num, self.banmasks[2])
-            
-            # Create the mask - only escape nick and host, not ident
-            mask = mask_template.replace("nick", re.escape(nick)) \
-                            .replace("ident", ident) \
-                            .replace("host", re.escape(host)) \
-                            .replace("phost", re.escape(host.split(".", 1)[1]) if "." in host else re.escape(host))
-            
-            if not self._validate_mask(mask):
-                raise ValueError("Generated invalid mask")
-                
-            return mask
+            return self._masks.build(irc.state.nickToHostmask(target), num)
         except Exception as e:
             logger.error(f"Error creating mask for {target}: {e}")
             raise
@@ -176,7 +1805,7 @@ class Blacklist(callbacks.Plugin):
         for attempt in range(max_retries):
             try:
                 # Pastes.io API endpoint for anonymous pastes
-                api_url = 'https://api.pastes.io/v1/pastes'
+                api_url = self.pasteApiUrl
                 
                 # Prepare the JSON payload for Pastes.io (no API key needed for anonymous)
                 post_data = {
@@ -233,7 +1862,7 @@ class Blacklist(callbacks.Plugin):
     def _createPasteFallback(self, content):
         """Fallback paste service using dpaste.com (no auth required)"""
         try:
-            api_url = 'https://dpaste.com/api/v2/'
+            api_url = self.pasteFallbackUrl
             
             post_data = {
                 'content': content,
@@ -257,71 +1886,7 @@ class Blacklist(callbacks.Plugin):
                 return paste_url + '.txt'
             else:
                 return "Error: All paste services unavailable"
-                
-            return mask
         except Exception as e:
-            logger.error(f"Error creating mask for {target}: {e}")
-            raise
-    
-    def _createPastebin(self, content):
-        """Create anonymous paste using Pastes.io API with retry logic"""
-        max_retries = 3
-        
-        for attempt in range(max_retries):
-            try:
-                # Pastes.io API endpoint for anonymous pastes
-                api_url = 'https://api.pastes.io/v1/pastes'
-                
-                # Prepare the JSON payload for Pastes.io (no API key needed for anonymous)
-                post_data = {
-                    'content': content,
-                    'name': 'Ban List Export',
-                    'private': False,  # Anonymous pastes can't be private
-                    'expire': 604800  # 1 week in seconds (7 days)
-                }
-                
-                # Convert to JSON and encode
-                json_data = json.dumps(post_data).encode('utf-8')
-                
-                # Create request with proper headers (no auth token needed)
-                request = urllib.request.Request(
-                    api_url,
-                    data=json_data,
-                    headers={
-                        'Content-Type': 'application/json',
-                        'User-Agent': 'Supybot-Blacklist-Plugin/1.0'
-                    },
-                    method='POST'
-                )
-                
-                with urllib.request.urlopen(request, timeout=10) as response:
-                    result = json.loads(response.read().decode('utf-8'))
-                
-                # Pastes.io returns a JSON response with paste details
-                if 'data' in result and 'key' in result['data']:
-                    paste_key = result['data']['key']
-                    # Return the raw paste URL
-                    return f'https://pastes.io/raw/{paste_key}'
-                else:
-                    error_msg = result.get('message', 'Unknown error')
-                    logger.warning(f"Pastes.io error: {error_msg}")
-                    if attempt == max_retries - 1:
-                        return f"Error: Paste service unavailable ({error_msg})"
-                    time.sleep(1)
-                    
-            except (urllib.error.URLError, urllib.error.HTTPError) as e:
-                logger.warning(f"Pastes.io attempt {attempt + 1} failed: {e}")
-                if attempt == max_retries - 1:
-                    return f"Error: Paste service unavailable ({str(e)})"
-                time.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"Unexpected error creating paste: {e}")
-                if attempt == max_retries - 1:
-                    return f"Error: Paste service unavailable ({str(e)})"
-                time.sleep(1)
-        
-        return "Error: Paste service unavailable after multiple retries"
             logger.error(f"Fallback paste service failed: {e}")
             return f"Error: Paste services unavailable ({str(e)})"
     
@@ -329,9 +1894,7 @@ class Blacklist(callbacks.Plugin):
         """Thread-safe removal from database"""
         with self._get_db() as db:
             if channel in db and mask in db[channel]:
-                del db[channel][mask]
-                if not db[channel]:  # Remove empty channel
-                    del db[channel]
+                self._db_del(channel, mask)
                 self._dbWrite()
                 logger.info(f"Removed {mask} from {channel} database")
 
@@ -349,9 +1912,7 @@ class Blacklist(callbacks.Plugin):
                 
                 with self._get_db() as db:
                     if channel not in db or mask not in db[channel]:
-                        if channel not in db:
-                            db[channel] = {}
-                        db[channel][mask] = [msg.nick, time.time(), '*user-added ban']
+                        self._db_set(channel, mask, [msg.nick, time.time(), '*user-added ban'])
                         self._dbWrite()
                         irc.reply(f'"{mask}" added to the banlist for {channel}.')
                         logger.info(f"Added manual ban {mask} in {channel} by {msg.nick}")
@@ -359,39 +1920,195 @@ class Blacklist(callbacks.Plugin):
             logger.error(f"Error in doMode: {e}")
 
     def doJoin(self, irc, msg):
-        """Handle user joins and apply bans"""
+        """Queue user joins for the enforcement worker"""
         try:
             channel = msg.args[0]
-            if (self.registryValue('enabled', channel) and 
-                irc.state.channels[channel].isHalfopPlus(irc.nick) and 
-                not ircutils.strEqual(msg.nick, irc.nick) and 
-                channel in self.db):
-                
-                with self._get_db() as db:
-                    for mask, (adder, timestamp, reason) in db[channel].items():
-                        if ircutils.hostmaskPatternEqual(mask, msg.prefix):
-                            irc.queueMsg(ircmsgs.ban(channel, mask))
-                            irc.queueMsg(ircmsgs.kick(channel, msg.nick, reason))
-                            
-                            expiry_time = self.registryValue('banlistExpiry', channel) * 60
-                            event_name = f'bl_unban_{channel}_{hash(mask)}'
-                            
-                            # Remove any existing event to avoid duplicates
-                            try:
-                                schedule.removeEvent(event_name)
-                            except KeyError:
-                                pass
-                            
-                            schedule.addEvent(
-                                lambda: irc.queueMsg(ircmsgs.unban(channel, mask)),
-                                time.time() + expiry_time,
-                                event_name
-                            )
-                            logger.info(f"Applied ban {mask} to {msg.nick} in {channel}")
-                            break
+            self._metrics.count('joins')
+            self._memberJoined(irc, channel, msg)
+            if not ircutils.strEqual(msg.nick, irc.nick):
+                if not self._joins.put((irc, channel, msg.nick, msg.prefix)):
+                    # The joiner is in the member table already; the whole
+                    # channel gets checked once the queue has caught up
+                    self._overflow[self._memberKey(irc, channel)] = (irc, channel)
+                    if self._joins.dropped % 100 == 1:
+                        logger.warning(f"Join queue full, {self._joins.dropped} joins dropped so far")
         except Exception as e:
             logger.error(f"Error in doJoin: {e}")
+    
+    def _enforceOverflow(self):
+        """Run an enforce pass over the channels that had joins dropped
+        while the queue was full.  Called by the join worker once it has
+        emptied the queue."""
+        while True:
+            try:
+                key, (irc, channel) = self._overflow.popitem()
+            except KeyError:
+                return
+            matchers = self._joinMatchers(irc, channel)
+            if matchers:
+                matched = self._enforceChannel(irc, channel, matchers)
+                logger.info(f"Checked {channel} after dropped joins, "
+                            f"{len(matched)} banmasks matched someone")
+
+    def _joinMatchers(self, irc, channel):
+        """The indexes joins to <channel> are checked against, or [] when
+        the bot cannot act there"""
+        if (self.registryValue('enabled', channel) and
+                channel in irc.state.channels and
+                irc.state.channels[channel].isHalfopPlus(irc.nick)):
+            return self._matchers(channel)
+        return []
+
+    def _enforceJoins(self, joins):
+        """Check a batch of queued (irc, channel, nick, hostmask) joins,
+        matching each banned host once, then queue all their bans and
+        kicks so they leave packed together.  Matching reads the indexes and
+        snapshots without taking _db_lock."""
+        hits = []
+        checked = 0
+        matchers = {}
+        hosts = {}  # (network, channel, folded host) -> mask banning all of it
+        for irc, channel, nick, prefix in joins:
+            key = (irc.network, channel)
+            if key not in matchers:
+                matchers[key] = self._joinMatchers(irc, channel)
+            if not matchers[key]:
+                continue
+            checked += 1
+            folded = ircutils.toLower(prefix)
+            hostKey = key + (folded.rpartition('@')[2],)
+            mask = hosts.get(hostKey)
+            if mask is None:
+                started = time.perf_counter()
+                for matcher in matchers[key]:
+                    mask = matcher.matchFolded(folded)
+                    if mask is not None:
+                        break
+                self._metrics.record('match', time.perf_counter() - started)
+                if mask is not None and mask.startswith('*!*@'):
+                    # Bans any nick and ident there, so it settles the
+                    # other clones joining from the same host
+                    hosts[hostKey] = mask
+            if mask is not None:
+                entry = self._lookupBan(channel, mask)
+                if entry is not None:  # removed in the meantime
+                    hits.append((irc, channel, nick, mask, entry[2]))
+        self._metrics.count('checked', checked)
+        self._metrics.count('matched', len(hits))
+        
+        scheduled = set()
+        for irc, channel, nick, mask, reason in hits:
+            self._modes.ban(irc, channel, mask)
+            self._modes.kick(irc, channel, nick, reason)
+            if (irc.network, channel, mask) not in scheduled:
+                scheduled.add((irc.network, channel, mask))
+                expiry_time = self.registryValue('banlistExpiry', channel) * 60
+                self._scheduleExpiry('unban', irc, channel, mask, expiry_time)
+            logger.info(f"Applied ban {mask} to {nick} in {channel}")
+
+    def doPart(self, irc, msg):
+        for channel in msg.args[0].split(','):
+            self._memberLeft(irc, channel, msg.nick)
+
+    def doKick(self, irc, msg):
+        channel = msg.args[0]
+        for nick in msg.args[1].split(','):
+            self._memberLeft(irc, channel, nick)
+
+    def doQuit(self, irc, msg):
+        for (network, channel), members in list(self._members.items()):
+            if network == irc.network:
+                members.pop(ircutils.toLower(msg.nick), None)
+
+    def doNick(self, irc, msg):
+        newNick = msg.args[0]
+        hostmask = ircutils.toLower(ircutils.joinHostmask(newNick, msg.user,
+                                                          msg.host))
+        for (network, channel), members in list(self._members.items()):
+            if network == irc.network and \
+                    members.pop(ircutils.toLower(msg.nick), None):
+                members[ircutils.toLower(newNick)] = (newNick, hostmask)
+
+    def doChghost(self, irc, msg):
+        # Rare enough to simply drop the tables; _memberTable rebuilds
+        # them the next time they are needed
+        for key in list(self._members):
+            if key[0] == irc.network:
+                self._members.pop(key, None)
+
+    @staticmethod
+    def _memberKey(irc, channel):
+        # Hooks see the server's spelling of the channel, commands whatever
+        # case the op typed
+        return (irc.network, ircutils.toLower(channel))
+
+    def _memberTable(self, irc, channel):
+        """Return {folded nick: (nick, folded hostmask)} for the members
+        of <channel>, built once from irc.state and then kept up to date
+        by the join/part/kick/quit/nick hooks"""
+        key = self._memberKey(irc, channel)
+        members = self._members.get(key)
+        if members is None:
+            members = {}
+            complete = True
+            for nick in irc.state.channels[channel].users:
+                try:
+                    hostmask = irc.state.nickToHostmask(nick)
+                except KeyError:
+                    complete = False  # still waiting for WHO replies
+                    continue
+                members[ircutils.toLower(nick)] = (nick, ircutils.toLower(hostmask))
+            if complete:
+                self._members[key] = members
+        return members
+
+    def _memberJoined(self, irc, channel, msg):
+        key = self._memberKey(irc, channel)
+        if ircutils.strEqual(msg.nick, irc.nick):
+            self._members.pop(key, None)
+        elif key in self._members:
+            self._members[key][ircutils.toLower(msg.nick)] = \
+                (msg.nick, ircutils.toLower(msg.prefix))
+
+    def _memberLeft(self, irc, channel, nick):
+        key = self._memberKey(irc, channel)
+        if ircutils.strEqual(nick, irc.nick):
+            self._members.pop(key, None)
+        elif key in self._members:
+            self._members[key].pop(ircutils.toLower(nick), None)
 
+    def _enforce(self, irc, channel, indexes, reasonFor):
+        """Kick every member of <channel> matching a mask of one of
+        <indexes> in one pass over the member table.  <reasonFor> maps a
+        mask to its kick reason.  Returns the set of masks that matched
+        someone."""
+        matched = set()
+        for nick, hostmask in list(self._memberTable(irc, channel).values()):
+            if ircutils.strEqual(nick, irc.nick):
+                continue
+            for index in indexes:
+                mask = index.matchFolded(hostmask)
+                if mask is not None:
+                    matched.add(mask)
+                    self._modes.kick(irc, channel, nick, reasonFor(mask))
+                    break
+        return matched
+
+    def _enforceChannel(self, irc, channel, matchers):
+        """Ban and kick every member of <channel> matching <matchers>, as
+        the enforce command does.  Returns the set of masks that matched."""
+        default_reason = self.registryValue('banReason', channel)
+        matched = self._enforce(irc, channel, matchers, lambda mask:
+                                (self._lookupBan(channel, mask) or
+                                 (None, None, default_reason))[2])
+        
+        expiry_time = self.registryValue('banlistExpiry', channel) * 60
+        for mask in matched:
+            if mask not in irc.state.channels[channel].bans:
+                self._modes.ban(irc, channel, mask)
+                self._scheduleExpiry('unban', irc, channel, mask, expiry_time)
+        return matched
+    
     def add(self, irc, msg, args, channel, target, reason):
         """[<channel>] <nick|mask> [<reason>]
         
@@ -504,50 +2221,27 @@ class Blacklist(callbacks.Plugin):
             reason = self.registryValue('banReason', channel)
         
         # Update database
-        with self._get_db() as db:
-            if channel not in db:
-                db[channel] = {}
-            db[channel][mask] = [msg.nick, int(time.time()), reason]
+        started = time.perf_counter()
+        self._db_set(channel, mask, [msg.nick, int(time.time()), reason])
         
         self._dbWrite()
         
         # Apply ban and kick matching users
-        irc.queueMsg(ircmsgs.ban(channel, mask))
+        self._modes.ban(irc, channel, mask)
         
-        for nick in irc.state.channels[channel].users:
-            if ircutils.hostmaskPatternEqual(mask, irc.state.nickToHostmask(nick)):
-                irc.queueMsg(ircmsgs.kick(channel, nick, reason))
+        self._enforce(irc, channel, [MaskIndex([mask])], lambda m: reason)
         
         # Schedule unban
         expiry_time = timer * 60 if timer else self.registryValue('banlistExpiry', channel) * 60
-        event_name = f'bl_unban_{channel}_{hash(mask)}'
-        
-        # Remove any existing event to avoid duplicates
-        try:
-            schedule.removeEvent(event_name)
-        except KeyError:
-            pass
-        
-        schedule.addEvent(
-            lambda: irc.queueMsg(ircmsgs.unban(channel, mask)),
-            time.time() + expiry_time,
-            event_name
-        )
+        self._scheduleExpiry('unban', irc, channel, mask, expiry_time)
         
         # Schedule database cleanup if timer is set
         if timer:
-            db_event_name = f'bl_db_unban_{channel}_{hash(mask)}'
-            try:
-                schedule.removeEvent(db_event_name)
-            except KeyError:
-                pass
-            
-            schedule.addEvent(
-                self._remove_from_db,
-                time.time() + (timer * 60),
-                args=(channel, mask),
-                name=db_event_name
-            )
+            self._scheduleExpiry('expire', irc, channel, mask, timer * 60)
+        else:
+            self._cancelExpiry('expire', irc, channel, mask)
+        self._metrics.record('ban', time.perf_counter() - started)
+        self._metrics.count('bans')
         
         irc.reply(f'"{mask}" added to banlist for {channel}.')
         logger.info(f"Added ban {mask} in {channel} by {msg.nick}")
@@ -566,25 +2260,15 @@ class Blacklist(callbacks.Plugin):
                 return
             
             # Remove scheduled events
-            event_names = [
-                f'bl_unban_{channel}_{hash(mask)}',
-                f'bl_db_unban_{channel}_{hash(mask)}'
-            ]
-            
-            for event_name in event_names:
-                try:
-                    schedule.removeEvent(event_name)
-                except KeyError:
-                    pass
+            self._cancelExpiry('unban', irc, channel, mask)
+            self._cancelExpiry('expire', irc, channel, mask)
             
             # Remove ban from channel if present
             if mask in irc.state.channels[channel].bans:
-                irc.queueMsg(ircmsgs.unban(channel, mask))
+                self._modes.unban(irc, channel, mask)
             
             # Remove from database
-            del db[channel][mask]
-            if not db[channel]:  # Remove empty channel
-                del db[channel]
+            self._db_del(channel, mask)
             self._dbWrite()
         
         irc.reply(f'"{mask}" removed from the banlist in {channel}.')
@@ -592,104 +2276,644 @@ class Blacklist(callbacks.Plugin):
     
     remove = wrap(remove, [('checkChannelCapability', 'op'), 'channel', 'text'])
 
-    def list(self, irc, msg, args, channel):
-        """[<channel>]
+    def list(self, irc, msg, args, channel, optlist):
+        """[<channel>] [--page <n>] [--since <minutes>] [--adder <nick>]
         
-        Returns a list of banmasks stored in <channel> (requires #channel,op capability)"""
-        with self._get_db() as db:
-            if channel not in db:
-                irc.reply(f'The banlist for {channel} is currently empty.')
+        Returns a list of banmasks stored in <channel>.  Large lists are
+        exported to a paste site unless a page is asked for; --since and
+        --adder only show bans added in the last <minutes> or by <nick>
+        (requires #channel,op capability)"""
+        opts = dict(optlist)
+        version, bans = self._view(channel)
+        if not bans:
+            irc.reply(f'The banlist for {channel} is currently empty.')
+            return
+        
+        if opts:
+            self._display_ban_page(irc, msg, channel, bans, version,
+                                   opts.get('page', 1), opts.get('since'),
+                                   opts.get('adder'))
+            return
+        
+        ban_count = len(bans)
+        
+        # Get the maximum inline entries from configuration
+        max_inline = self.registryValue('maxInlineEntries', channel)
+        if max_inline is None:  # Fallback if not set
+            max_inline = 5
+        
+        if ban_count <= max_inline:
+            self._display_ban_list(irc, channel, bans)
+            return
+        
+        # Large lists go to a paste site, reusing the last export
+        # while the banlist is unchanged
+        with self._list_lock:
+            cached = self._pastes.get(channel)
+            if cached and cached[0] == version \
+                    and time.time() - cached[2] < self.pasteCacheTime:
+                irc.reply(f"Ban list too large ({ban_count} entries). View at: {cached[1]}")
                 return
-            
-            ban_count = len(db[channel])
-            
-            # Get the maximum inline entries from configuration
-            max_inline = self.registryValue('maxInlineEntries', channel)
-            if max_inline is None:  # Fallback if not set
-                max_inline = 5
-            
-            # Use pastebin for large lists (more than maxInlineEntries entries)
-            if ban_count > max_inline:
-                # Create formatted content for pastebin
-                content = f"Ban List for {channel} - {ban_count} entries\n"
-                content += "=" * 60 + "\n\n"
-                
-                for banmask, (adder, timestamp, reason) in db[channel].items():
-                    elapsed = self._elapsed(timestamp)
-                    content += f"Mask: {banmask}\n"
-                    content += f"Added by: {adder} ({elapsed} ago)\n"
-                    content += f"Reason: {reason}\n"
-                    content += "-" * 40 + "\n"
-                
-                # Create pastebin URL
-                pastebin_url = self._createPastebin(content)
-                if pastebin_url.startswith('https://'):
-                    irc.reply(f"Ban list too large ({ban_count} entries). View at: {pastebin_url}")
-                else:
-                    # Fallback to regular display if pastebin fails
-                    irc.reply(f"Pastebin failed: {pastebin_url}. Displaying first {max_inline} entries:")
-                    self._display_ban_list(irc, channel, db[channel], limit=max_inline)
+            waiters = self._exports.get(channel)
+            if waiters is not None:
+                # An upload is already running, answer when it finishes
+                waiters.append(irc)
+                return
+            self._exports[channel] = [irc]
+        content = self._formatBanList(channel, bans)
+        preview = dict(itertools.islice(bans.items(), max_inline))
+        
+        threading.Thread(target=self._exportBanList,
+                         args=(channel, version, ban_count, content, preview),
+                         name=f'Blacklist export {channel}', daemon=True).start()
+    
+    list = wrap(list, [('checkChannelCapability', 'op'), 'channel',
+                       getopts({'page': 'positiveInt', 'since': 'positiveInt',
+                                'adder': 'somethingWithoutSpaces'})])
+    
+    def _formatBanList(self, channel, bans):
+        """Render a banlist as the plain text body of a paste"""
+        out = io.StringIO()
+        out.write(f"Ban List for {channel} - {len(bans)} entries\n")
+        out.write("=" * 60 + "\n\n")
+        for banmask, (adder, timestamp, reason) in bans.items():
+            out.write(f"Mask: {banmask}\n"
+                      f"Added by: {adder} ({self._elapsed(timestamp)} ago)\n"
+                      f"Reason: {reason}\n")
+            out.write("-" * 40 + "\n")
+        return out.getvalue()
+    
+    def _exportBanList(self, channel, version, ban_count, content, preview):
+        """Upload a rendered banlist and answer everyone who asked for it.
+        Runs on its own thread so retries never hold a command worker."""
+        try:
+            pastebin_url = self._createPastebin(content)
+        except Exception as e:
+            pastebin_url = f"Error: {e}"
+        with self._list_lock:
+            waiters = self._exports.pop(channel, [])
+            if pastebin_url.startswith('https://'):
+                self._pastes[channel] = (version, pastebin_url, time.time())
+        for irc in waiters:
+            if pastebin_url.startswith('https://'):
+                irc.reply(f"Ban list too large ({ban_count} entries). View at: {pastebin_url}")
             else:
-                self._display_ban_list(irc, channel, db[channel])
+                # Fallback to regular display if pastebin fails
+                irc.reply(f"Pastebin failed: {pastebin_url}. Displaying first {len(preview)} entries:")
+                self._display_ban_list(irc, channel, preview, limit=len(preview),
+                                       total=ban_count)
     
-    list = wrap(list, [('checkChannelCapability', 'op'), 'channel'])
+    def _display_ban_list(self, irc, channel, bans, limit=None, total=None):
+        """Display ban list in channel, several entries per line"""
+        total = len(bans) if total is None else total
+        if limit and total > limit:
+            irc.reply(f"Showing first {limit} of {total} entries:")
+        entries = itertools.islice(bans.items(), limit)
+        for line in self._packBans(entries):
+            irc.reply(line)
     
-    def _display_ban_list(self, irc, channel, bans, limit=None):
-        """Display ban list in channel"""
-        ban_list = list(bans.items())
-        if limit:
-            ban_list = ban_list[:limit]
-            if len(bans) > limit:
-                irc.reply(f"Showing first {limit} of {len(bans)} entries:")
+    def _display_ban_page(self, irc, msg, channel, bans, version, page,
+                          since, adder):
+        """Display one page of the (filtered) ban snapshot taken at
+        <version>.  Asking for the page after the last one shown resumes
+        the previous walk instead of skipping from the start again."""
+        key = (irc.network, channel, msg.nick)
+        filters = (since, adder)
+        with self._list_lock:
+            cursor = self._cursors.pop(key, None)
+        if cursor is None or not cursor.resumes(bans, version, filters, page):
+            lines = self._packBans(self._filterBans(bans, since, adder))
+            cursor = ListCursor(bans, version, filters, lines)
+        pageLines = self.registryValue('pageLines', channel)
+        shown = cursor.take(page, pageLines)
+        if not shown:
+            if page == 1:
+                irc.reply(f'No matching bans in {channel}.')
+            else:
+                irc.reply(f'There is no page {page} for {channel}.')
+            return
+        for line in shown:
+            irc.reply(line)
+        if cursor.more():
+            irc.reply(f'Page {page} of {channel}, use --page {page + 1} for more.')
+            with self._list_lock:
+                self._cursors[key] = cursor
+                while len(self._cursors) > self.listCursors:
+                    self._cursors.popitem(last=False)
+    
+    def _filterBans(self, bans, since=None, adder=None):
+        """Lazily yield the (mask, entry) pairs added in the last <since>
+        minutes and/or by <adder>"""
+        cutoff = time.time() - since * 60 if since else None
+        adder = ircutils.toLower(adder) if adder else None
+        for banmask, entry in bans.items():
+            if cutoff is not None and entry[1] < cutoff:
+                continue
+            if adder is not None and ircutils.toLower(entry[0]) != adder:
+                continue
+            yield banmask, entry
+    
+    def _packBans(self, entries):
+        """Format (mask, entry) pairs and pack them into reply lines of at
+        most listLineBudget bytes"""
+        line = []
+        size = 0
+        for banmask, (adder, timestamp, reason) in entries:
+            text = f'{banmask} - Added by {adder} {self._elapsed(timestamp)} ago (reason: {reason})'
+            length = len(text.encode('utf-8')) + 3  # ' | '
+            if line and size + length > self.listLineBudget:
+                yield ' | '.join(line)
+                line = []
+                size = 0
+            line.append(text)
+            size += length
+        if line:
+            yield ' | '.join(line)
+
+    def enforce(self, irc, msg, args, channel):
+        """[<channel>]
         
-        for banmask, (adder, timestamp, reason) in ban_list:
-            elapsed = self._elapsed(timestamp)
-            irc.reply(f'{banmask} - Added by {adder} {elapsed} ago (reason: {reason})')
+        Bans and kicks everyone currently in <channel> who matches its
+        banlist (requires #channel,op capability)"""
+        if not self.registryValue('enabled', channel):
+            irc.error(f'Database is disabled in {channel}.')
+            return
+        if channel not in irc.state.channels:
+            irc.error(f'I\'m not in {channel}.')
+            return
+        if not irc.state.channels[channel].isHalfopPlus(irc.nick):
+            irc.error(f'I have no powers in {channel}.')
+            return
+        matchers = self._matchers(channel)
+        if not matchers:
+            irc.reply(f'The banlist for {channel} is currently empty.')
+            return
+        matched = self._enforceChannel(irc, channel, matchers)
+        irc.reply(f'{len(matched)} banmasks in {channel} matched someone.')
+    
+    enforce = wrap(enforce, [('checkChannelCapability', 'op'), 'channel'])
 
-    def cleanup(self, irc, msg, args, channel):
-        """[<channel>] - Clean up expired bans from database"""
+    def _dataFile(self, irc, filename):
+        """Resolve <filename> inside the data directory, or reply with an
+        error and return None"""
+        if not filename or os.path.basename(filename) != filename \
+                or filename.startswith('.'):
+            irc.error('Give a plain file name from the Blacklist data directory.')
+            return None
+        datadir = os.path.dirname(self.dbfile)
+        os.makedirs(datadir, exist_ok=True)
+        return os.path.join(datadir, filename)
+    
+    def _readBans(self, fd, csvFormat):
+        """Stream the records of a JSON-lines or CSV file as dicts"""
+        if csvFormat:
+            yield from csv.DictReader(fd)
+            return
+        for line in fd:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None  # skipped like any other invalid record
+    
+    def _importBans(self, irc, msg, args, channel, filename):
+        """[<channel>] <file>
+        
+        Adds the bans stored in <file> to the banlist of <channel> in one go.
+        <file> lives in the Blacklist data directory and holds one JSON
+        object per line, or is a .csv file with a header; each record has a
+        mask and optionally adder, timestamp and reason (requires
+        #channel,op capability)"""
+        path = self._dataFile(irc, filename)
+        if path is None:
+            return
+        started = time.perf_counter()
+        now = time.time()
+        default_reason = self.registryValue('banReason', channel)
+        entries = []
+        skipped = 0
+        try:
+            with open(path, newline='', encoding='utf-8') as fd:
+                for record in self._readBans(fd, path.endswith('.csv')):
+                    try:
+                        mask = record['mask']
+                        timestamp = float(record.get('timestamp') or now)
+                        adder = record.get('adder') or msg.nick
+                        reason = record.get('reason') or default_reason
+                    except (TypeError, KeyError, ValueError, AttributeError):
+                        skipped += 1
+                        continue
+                    # Check everything before storing anything, so a bad
+                    # record cannot abort the import halfway through
+                    if not self._validate_mask(mask) or \
+                            not math.isfinite(timestamp) or \
+                            not isinstance(adder, str) or \
+                            not isinstance(reason, str):
+                        skipped += 1
+                        continue
+                    entries.append((mask, [adder, timestamp, reason]))
+        except (OSError, ValueError, csv.Error) as e:
+            irc.error(f'Could not read {filename}: {e}')
+            return
+        
+        added = self._db_setMany(channel, entries)
+        self._writer.flush()
+        elapsed = time.perf_counter() - started
+        irc.reply(f'Imported {added} bans into {channel} from {filename} '
+                  f'({skipped} invalid skipped) in {elapsed:.2f}s '
+                  f'({added / max(elapsed, 1e-6):.0f}/s).')
+        logger.info(f"Imported {added} bans into {channel} from {path} by {msg.nick}")
+    
+    _importBans = wrap(_importBans, [('checkChannelCapability', 'op'),
+                                     'channel', 'somethingWithoutSpaces'])
+    # 'import' is a Python keyword; Limnoria looks commands up by attribute
+    # name, so bind it in the class namespace under that name
+    locals()['import'] = _importBans
+    
+    def export(self, irc, msg, args, channel, filename):
+        """[<channel>] <file>
+        
+        Writes the banlist of <channel> to <file> in the Blacklist data
+        directory, as JSON lines or as CSV when <file> ends in .csv
+        (requires #channel,op capability)"""
+        path = self._dataFile(irc, filename)
+        if path is None:
+            return
+        started = time.perf_counter()
+        tmpfile = f"{path}.tmp"
+        version, bans = self._view(channel)
+        if not bans:
+            irc.reply(f'The banlist for {channel} is currently empty.')
+            return
+        try:
+            with open(tmpfile, 'w', newline='', encoding='utf-8') as fd:
+                if path.endswith('.csv'):
+                    writer = csv.writer(fd)
+                    writer.writerow(('mask', 'adder', 'timestamp', 'reason'))
+                    for banmask, entry in bans.items():
+                        writer.writerow((banmask,) + tuple(entry))
+                else:
+                    for banmask, (adder, timestamp, reason) in bans.items():
+                        fd.write(json.dumps({'mask': banmask, 'adder': adder,
+                                             'timestamp': timestamp,
+                                             'reason': reason}) + '\n')
+            count = len(bans)
+            os.replace(tmpfile, path)
+        except OSError as e:
+            irc.error(f'Could not write {filename}: {e}')
+            return
+        elapsed = time.perf_counter() - started
+        irc.reply(f'Exported {count} bans from {channel} to {filename} '
+                  f'in {elapsed:.2f}s ({count / max(elapsed, 1e-6):.0f}/s).')
+    
+    export = wrap(export, [('checkChannelCapability', 'op'), 'channel',
+                           'somethingWithoutSpaces'])
+    
+    def sync(self, irc, msg, args, channel):
+        """[<channel>]
+        
+        Adds the bans currently set on <channel> that are not in its
+        banlist yet (requires #channel,op capability)"""
+        if channel not in irc.state.channels:
+            irc.error(f'I\'m not in {channel}.')
+            return
+        started = time.perf_counter()
+        now = time.time()
+        live = list(irc.state.channels[channel].bans)
         with self._get_db() as db:
-            if channel not in db:
-                irc.reply(f'No bans found for {channel}.')
+            known = db.get(channel, ())
+            entries = [(mask, [msg.nick, now, '*synced ban'])
+                       for mask in live
+                       if mask not in known and self._validate_mask(mask)]
+            added = self._db_setMany(channel, entries)
+        if added:
+            self._writer.flush()
+        elapsed = time.perf_counter() - started
+        irc.reply(f'Added {added} of the {len(live)} bans set on {channel} '
+                  f'in {elapsed:.2f}s.')
+    
+    sync = wrap(sync, [('checkChannelCapability', 'op'), 'channel'])
+
+    def setadd(self, irc, msg, args, name, mask, reason):
+        """<set> <mask> [<reason>]
+        
+        Adds <mask> to the global ban set <set>; every channel subscribed
+        to <set> bans it on join (requires admin capability)"""
+        if not self._validate_mask(mask):
+            irc.error(f'"{mask}" is not a valid banmask.')
+            return
+        if ircutils.hostmaskPatternEqual(mask, irc.prefix):
+            irc.error('Cannot blacklist myself!')
+            return
+        if not reason:
+            reason = self.registryValue('banReason')
+        self._db_set(self._setKey(name), mask, [msg.nick, time.time(), reason])
+        self._dbWrite()
+        irc.reply(f'"{mask}" added to ban set {name}.')
+    
+    setadd = wrap(setadd, ['admin', 'somethingWithoutSpaces',
+                           'somethingWithoutSpaces', optional('text')])
+    
+    def setremove(self, irc, msg, args, name, mask):
+        """<set> <mask>
+        
+        Removes <mask> from the global ban set <set> (requires admin
+        capability)"""
+        key = self._setKey(name)
+        with self._get_db() as db:
+            if mask not in db.get(key, ()):
+                irc.error(f'"{mask}" is not in ban set {name}.')
                 return
+            self._db_del(key, mask)
+        self._dbWrite()
+        irc.reply(f'"{mask}" removed from ban set {name}.')
+    
+    setremove = wrap(setremove, ['admin', 'somethingWithoutSpaces',
+                                 'somethingWithoutSpaces'])
+    
+    def setlist(self, irc, msg, args, optlist, name):
+        """[--page <n>] [<set>]
+        
+        Lists the global ban sets, or the masks in <set> (requires admin
+        capability)"""
+        if name is None:
+            with self._get_db() as db:
+                sets = sorted(key[len(self.setPrefix):] for key in db
+                              if self._isSet(key))
+                if not sets:
+                    irc.reply('There are no ban sets.')
+                    return
+                irc.reply(', '.join(f'{name} ({len(db[self._setKey(name)])})'
+                                    for name in sets))
+            return
+        version, bans = self._view(self._setKey(name))
+        if not bans:
+            irc.reply(f'Ban set {name} is empty.')
+            return
+        self._display_ban_page(irc, msg, self._setKey(name), bans, version,
+                               dict(optlist).get('page', 1), None, None)
+    
+    setlist = wrap(setlist, ['admin', getopts({'page': 'positiveInt'}),
+                             optional('somethingWithoutSpaces')])
+    
+    def subscribe(self, irc, msg, args, channel, name):
+        """[<channel>] <set>
+        
+        Makes <channel> ban the masks of the global ban set <set> too
+        (requires #channel,op capability)"""
+        sets = set(self.registryValue('banSets', channel))
+        sets.add(name.lower())
+        self.setRegistryValue('banSets', sorted(sets), channel=channel)
+        if self._setKey(name) in self.db:
+            irc.reply(f'{channel} now uses ban set {name}.')
+        else:
+            # Allowed, so a channel can subscribe before the set is filled
+            irc.reply(f'{channel} now uses ban set {name}, which is empty '
+                      f'or does not exist yet.')
+    
+    subscribe = wrap(subscribe, [('checkChannelCapability', 'op'), 'channel',
+                                 'somethingWithoutSpaces'])
+    
+    def unsubscribe(self, irc, msg, args, channel, name):
+        """[<channel>] <set>
+        
+        Stops <channel> from using the global ban set <set> (requires
+        #channel,op capability)"""
+        sets = set(self.registryValue('banSets', channel))
+        if name.lower() not in sets:
+            irc.error(f'{channel} does not use ban set {name}.')
+            return
+        sets.discard(name.lower())
+        self.setRegistryValue('banSets', sorted(sets), channel=channel)
+        self._pruneSetMatchers()
+        irc.reply(f'{channel} no longer uses ban set {name}.')
+    
+    unsubscribe = wrap(unsubscribe, [('checkChannelCapability', 'op'),
+                                     'channel', 'somethingWithoutSpaces'])
+    
+    def joinstats(self, irc, msg, args):
+        """takes no arguments
+        
+        Shows how far the join enforcement worker is behind (requires admin
+        capability)"""
+        m = self._joins.metrics()
+        irc.reply(f'Join queue: {m["depth"]} waiting (max {m["maxDepth"]}), '
+                  f'{m["processed"]} processed, {m["dropped"]} dropped, '
+                  f'lag {m["lag"]:.3f}s (max {m["maxLag"]:.3f}s).')
+    
+    joinstats = wrap(joinstats, ['admin'])
+    
+    @staticmethod
+    def _duration(seconds):
+        if seconds < 1e-3:
+            return f'{seconds * 1e6:.0f}us'
+        if seconds < 1:
+            return f'{seconds * 1e3:.1f}ms'
+        return f'{seconds:.2f}s'
+    
+    def _latency(self, histogram):
+        return (f'p50 {self._duration(histogram.percentile(.5))}, '
+                f'p99 {self._duration(histogram.percentile(.99))}, '
+                f'max {self._duration(histogram.max)}')
+    
+    def _metricsLine(self):
+        """The counters and latencies since load, as one line"""
+        counters, histograms = self._metrics.snapshot()
+        h = lambda name: histograms.get(name) or Histogram()
+        return (f'Joins: {counters["joins"]} seen, {counters["checked"]} checked, '
+                f'{counters["matched"]} matched, match {self._latency(h("match"))}. '
+                f'Bans: {counters["bans"]} added, {self._latency(h("ban"))}. '
+                f'Lock wait: {self._latency(h("lockWait"))}. '
+                f'Writes: {counters["writes"]} ({counters["changes"]} changes, '
+                f'{counters["writeBytes"]} bytes), {self._latency(h("write"))}. '
+                f'Pending: {len(schedule.schedule.events)} scheduled events, '
+                f'{len(self._expiries)} timers, {self._joins.metrics()["depth"]} joins. '
+                f'Since {self._elapsed(self._metrics.started)} ago.')
+    
+    def _logMetrics(self):
+        logger.info(f"Blacklist metrics: {self._metricsLine()}")
+    
+    def metrics(self, irc, msg, args):
+        """takes no arguments
+        
+        Shows how many joins were checked and matched, how long matching,
+        adding bans, waiting for the database lock and writing to disk
+        took, and what is waiting to run (requires admin capability)"""
+        irc.reply(self._metricsLine())
+    
+    metrics = wrap(metrics, ['admin'])
+    
+    def _expireBans(self, channel, cutoff, limit=None):
+        """Delete up to <limit> bans of <channel> added before <cutoff>,
+        oldest first.  Callers must hold _db_lock."""
+        expired = self.db[channel].expired(cutoff, limit)
+        for mask in expired:
+            self._db_del(channel, mask)
+        return expired
+    
+    def _expireUnloaded(self, channel, cutoff, limit):
+        """Delete up to <limit> bans of the unloaded <channel> added before
+        <cutoff>, oldest first, without loading it.  Its rows are read from
+        the store without _db_lock; the lock is only held to queue the
+        deletions.  Returns their masks."""
+        with self._get_db():
+            version = self._versions.get(channel, 0)
+            records = [record for record in self._inflight + self._pending
+                       if record['c'] == channel]
+        try:
+            db = {channel: self._store.loadChannel(channel)}
+        except Exception as e:
+            logger.error(f"Failed to load bans for {channel}: {e}")
+            return []
+        # Changes not stored yet when we looked; replaying stored ones is
+        # harmless
+        for record in records:
+            BanJournal._apply(db, record)
+        bans = db.get(channel, {})
+        expired = [mask for timestamp, mask in heapq.nsmallest(
+            limit, ((entry[1], mask) for mask, entry in bans.items()
+                    if entry[1] < cutoff))]
+        for mask in expired:
+            del bans[mask]
+        oldest = min((entry[1] for entry in bans.values()), default=None)
+        with self._get_db() as db:
+            if db.peek(channel) is not None or \
+                    self._versions.get(channel, 0) != version:
+                return []  # loaded or changed meanwhile, left for next time
+            if not expired:
+                self._oldest[channel] = oldest
+                return expired
+            for mask in expired:
+                self._pending.append({'op': 'del', 'c': channel, 'm': mask})
+            self._versions[channel] = version + 1
+            if bans:
+                self._oldest[channel] = oldest
+            else:
+                del db[channel]
+                self._oldest.pop(channel, None)
+        return expired
+    
+    def _expirySweep(self):
+        """Periodic cleanup of every channel with autoCleanup on, in name
+        order.  Removes at most sweepBudget bans and reads at most
+        sweepLoads unloaded channels per run; the channel a run stops at
+        is where the next one starts.  This runs on the scheduler thread,
+        so _db_lock is only taken per channel to expire, never across I/O.
+        Unloaded channels are not loaded into the cache, and are skipped
+        while their oldest ban is not due, as told by the store's index or
+        the oldest timestamp recorded when they were unloaded."""
+        # Also catches subscriptions dropped with the config command
+        self._pruneSetMatchers()
+        budget = self.sweepBudget
+        loads = self.sweepLoads
+        now = time.time()
+        with self._get_db() as db:
+            channels = sorted(db)
+        if self._sweepFrom is not None:
+            start = bisect.bisect_left(channels, self._sweepFrom)
+            channels = channels[start:] + channels[:start]
+        self._sweepFrom = None
+        for channel in channels:
+            if self._isSet(channel) or \
+                    not self.registryValue('autoCleanup', channel):
+                continue
+            cutoff = now - self.registryValue('banlistExpiry', channel) * 60
+            if self.db.peek(channel) is not None:
+                with self._get_db() as db:
+                    expired = []
+                    if db.peek(channel) is not None:
+                        expired = self._expireBans(channel, cutoff, budget)
+            else:
+                if self._store.indexed:
+                    oldest = self._store.stats(channel)[1]
+                    if oldest is None:
+                        continue
+                else:
+                    oldest = self._oldest.get(channel)
+                if oldest is not None and oldest >= cutoff:
+                    continue
+                if not loads:
+                    self._sweepFrom = channel
+                    break
+                loads -= 1
+                expired = self._expireUnloaded(channel, cutoff, budget)
+            budget -= len(expired)
+            if budget <= 0:
+                self._sweepFrom = channel
+                break
+        if budget < self.sweepBudget:
+            self._dbWrite()
+            logger.info(f"Expiry sweep removed {self.sweepBudget - budget} bans")
+    
+    def _cleanup(self, channel):
+        """Delete the expired bans of <channel>.  Returns their masks, or
+        None when <channel> has no bans."""
+        if self._store.indexed:
+            # Make sure the store has every change before the ranged delete
+            self._writer.flush()
+        with self._get_db() as db:
+            # Load the channel before the store prunes it, or an unloaded
+            # channel would be read back without the masks being deleted
+            bans = db.get(channel)
+            if bans is None:
+                return None
             
             expired = []
             current_time = time.time()
             expiry_duration = self.registryValue('banlistExpiry', channel) * 60
             
-            for mask, (adder, timestamp, reason) in list(db[channel].items()):
-                if current_time - timestamp > expiry_duration:
-                    expired.append(mask)
-                    del db[channel][mask]
+            if self._store.indexed:
+                cutoff = current_time - expiry_duration
+                for mask in self._store.expire(channel, cutoff):
+                    # Skip masks re-added since; their fresh entry is still pending
+                    if mask in bans and bans[mask][1] < cutoff:
+                        expired.append(mask)
+                        self._db_del(channel, mask, journal=False)
+            else:
+                expired = self._expireBans(channel, current_time - expiry_duration)
             
             if expired:
                 self._dbWrite()
-                irc.reply(f'Removed {len(expired)} expired bans from {channel}.')
-                logger.info(f"Cleaned up {len(expired)} expired bans from {channel}")
-            else:
-                irc.reply(f'No expired bans found in {channel}.')
+        return expired
+    
+    def cleanup(self, irc, msg, args, channel):
+        """[<channel>] - Clean up expired bans from database"""
+        expired = self._cleanup(channel)
+        if expired is None:
+            irc.reply(f'No bans found for {channel}.')
+        elif expired:
+            irc.reply(f'Removed {len(expired)} expired bans from {channel}.')
+            logger.info(f"Cleaned up {len(expired)} expired bans from {channel}")
+        else:
+            irc.reply(f'No expired bans found in {channel}.')
     
     cleanup = wrap(cleanup, [('checkChannelCapability', 'op'), 'channel'])
 
     def stats(self, irc, msg, args, channel):
         """[<channel>] - Show ban statistics"""
+        now = time.time()
+        # The table keeps these aggregates up to date, so reading them
+        # under the lock is cheap and needs no snapshot
         with self._get_db() as db:
-            if channel not in db:
-                irc.reply(f'No bans found for {channel}.')
-                return
-            
-            total_bans = len(db[channel])
-            if total_bans == 0:
-                irc.reply(f'No bans found for {channel}.')
-                return
-            
-            timestamps = [v[1] for v in db[channel].values()]
-            oldest = min(timestamps)
-            newest = max(timestamps)
-            
-            irc.reply(f'Bans in {channel}: {total_bans} total, '
-                     f'oldest: {self._elapsed(oldest)} ago, '
-                     f'newest: {self._elapsed(newest)} ago')
+            bans = db.get(channel)
+            if bans:
+                total_bans = len(bans)
+                oldest = bans.oldest()
+                newest = bans.newest()
+                top = bans.topAdders(self.statsTopAdders)
+                rates = [bans.addedSince(days, now)
+                         for days in self.statsWindows]
+        if not bans:
+            irc.reply(f'No bans found for {channel}.')
+            return
+        
+        irc.reply(f'Bans in {channel}: {total_bans} total, '
+                 f'oldest: {self._elapsed(oldest)} ago, '
+                 f'newest: {self._elapsed(newest)} ago. '
+                 f'Top adders: {", ".join(f"{adder} ({count})" for adder, count in top)}. '
+                 f'Added in the last {"/".join(map(str, self.statsWindows))} days: '
+                 f'{"/".join(map(str, rates))}.')
     
     stats = wrap(stats, [('checkChannelCapability', 'op'), 'channel'])
 
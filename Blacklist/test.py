@@ -0,0 +1,846 @@
+###
+# Copyright (c) 2022, Mike Oxlong
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from supybot.test import *
+from supybot import ircmsgs, ircutils
+
+from .plugin import BanJournal, BanTable, Blacklist, ChannelCache, \
+    ChannelJournalStore, CoalescingWriter, Histogram, MaskBuilder, \
+    MaskIndex, SqliteStore, StringTable
+
+
+class MaskIndexTestCase(SupyTestCase):
+    masks = [
+        'spam!bot@evil.example.com',
+        '*!*@1.2.3.4',
+        '*!*bad@*.badhost.net',
+        '*!troll@*',
+        'nick?!*@*.ex[am]ple.org',
+        '*!*@*',
+    ]
+    hostmasks = [
+        'spam!bot@evil.example.com',
+        'SPAM!bot@Evil.Example.COM',
+        'x!y@1.2.3.4',
+        'x!~bad@a.b.badhost.net',
+        'x!bad@badhost.net',
+        'someone!troll@anywhere',
+        'nick1!u@h.ex{am}ple.org',
+        'nick12!u@h.ex[am]ple.org',
+        'innocent!user@nowhere.example',
+    ]
+
+    def testAgreesWithHostmaskPatternEqual(self):
+        for n in range(1, len(self.masks) + 1):
+            masks = self.masks[:n]
+            index = MaskIndex(masks)
+            for hostmask in self.hostmasks:
+                expected = [m for m in masks
+                            if ircutils.hostmaskPatternEqual(m, hostmask)]
+                found = index.match(hostmask)
+                if expected:
+                    self.assertIn(found, expected, hostmask)
+                else:
+                    self.assertIsNone(found, hostmask)
+
+    def testIncrementalUpdates(self):
+        index = MaskIndex(self.masks)
+        index.discard('*!*@*')
+        self.assertIsNone(index.match('innocent!user@nowhere.example'))
+        index.discard('*!*bad@*.badhost.net')
+        self.assertIsNone(index.match('x!~bad@a.b.badhost.net'))
+        index.add('*!*@*.b.badhost.net')
+        self.assertEqual(index.match('x!~bad@a.b.badhost.net'),
+                         '*!*@*.b.badhost.net')
+        self.assertEqual(len(index), len(self.masks) - 1)
+
+    def testExactMasksDifferingInCase(self):
+        index = MaskIndex(['Bad!u@h.example', 'bad!u@h.example'])
+        index.discard('Bad!u@h.example')
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.match('BAD!u@H.example'), 'bad!u@h.example')
+        index.discard('bad!u@h.example')
+        self.assertIsNone(index.match('bad!u@h.example'))
+
+
+class BanJournalTestCase(SupyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'blacklist.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super().tearDown()
+
+    def testReplayDropsTornRecord(self):
+        journal = BanJournal(self.path)
+        self.assertEqual(journal.load(), {})
+        journal.append([
+            {'op': 'set', 'c': '#a', 'm': 'a!b@c', 'v': ['op', 1, 'r']},
+            {'op': 'set', 'c': '#a', 'm': 'd!e@f', 'v': ['op', 2, 'r']},
+            {'op': 'del', 'c': '#a', 'm': 'a!b@c'},
+        ])
+        journal.close()
+        with open(journal.journalPath, 'ab') as f:
+            f.write(b'{"op":"set","c":"#a"')
+        journal = BanJournal(self.path)
+        self.assertEqual(journal.load(), {'#a': {'d!e@f': ['op', 2, 'r']}})
+        journal.append([{'op': 'del', 'c': '#a', 'm': 'd!e@f'}])
+        journal.close()
+        self.assertEqual(BanJournal(self.path).load(), {})
+
+    def testInterruptedCompactionIsFinishedOnLoad(self):
+        journal = BanJournal(self.path)
+        journal.load()
+        journal.append([{'op': 'set', 'c': '#a', 'm': 'a!b@c',
+                         'v': ['op', 1, 'r']}])
+        journal.rotate()
+        journal.append([{'op': 'set', 'c': '#b', 'm': 'x!y@z',
+                         'v': ['op', 2, 'r']}])
+        journal.close()
+        db = BanJournal(self.path).load()
+        self.assertEqual(set(db), {'#a', '#b'})
+        self.assertFalse(os.path.exists(journal.rotatedPath))
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), db)
+
+
+class ChannelJournalStoreTestCase(SupyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.legacy = os.path.join(self.dir, 'blacklist.json')
+        self.channels = os.path.join(self.dir, 'channels')
+        with open(self.legacy, 'w') as f:
+            json.dump({'#a': {'a!b@c': ['op', 100, 'r'],
+                              'd!e@f': ['op', 200, 'r']},
+                       '#b.json/x': {'x!y@z': ['op', 300, 'r']}}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super().tearDown()
+
+    def testLegacyDatabaseIsSplitPerChannel(self):
+        store = ChannelJournalStore(self.channels, legacyPath=self.legacy)
+        self.assertEqual(sorted(store.channels()), ['#a', '#b.json/x'])
+        self.assertFalse(os.path.exists(self.legacy))
+        store.append([{'op': 'del', 'c': '#a', 'm': 'd!e@f'},
+                      {'op': 'set', 'c': '#new', 'm': 'n!n@n',
+                       'v': ['op', 400, 'r']}])
+        store.close()
+        store = ChannelJournalStore(self.channels, legacyPath=self.legacy)
+        self.assertEqual(sorted(store.channels()), ['#a', '#b.json/x', '#new'])
+        self.assertEqual(store.loadChannel('#a'), {'a!b@c': ['op', 100, 'r']})
+        self.assertEqual(store.loadChannel('#b.json/x'),
+                         {'x!y@z': ['op', 300, 'r']})
+        self.assertEqual(store.loadChannel('#nothing'), {})
+
+    def testSqliteImportsJsonDataOnce(self):
+        legacy = ChannelJournalStore(self.channels, legacyPath=self.legacy)
+        path = os.path.join(self.dir, 'blacklist.db')
+        store = SqliteStore(path, legacy=legacy)
+        self.assertEqual(sorted(store.channels()), ['#a', '#b.json/x'])
+        store.append([{'op': 'del', 'c': '#a', 'm': 'd!e@f'}])
+        store.close()
+        store = SqliteStore(path, legacy=legacy)
+        self.assertEqual(store.loadChannel('#a'), {'a!b@c': ['op', 100, 'r']})
+        self.assertEqual(tuple(store.stats('#a')), (1, 100, 100))
+        self.assertEqual(store.expire('#a', 150), ['a!b@c'])
+        self.assertEqual(tuple(store.stats('#a')), (0, None, None))
+        store.close()
+
+
+class BanTableTestCase(SupyTestCase):
+    def testBehavesLikeADictAndSharesStrings(self):
+        strings = StringTable()
+        tables = [BanTable(strings) for i in range(3)]
+        for table in tables:
+            for i in range(100):
+                table['*!*@%d.example' % i] = ['op', 1000 + i, 'default']
+        self.assertEqual(len(strings), 2)
+        table = tables[0]
+        self.assertEqual(table['*!*@5.example'], ('op', 1005, 'default'))
+        table['*!*@5.example'] = ['other', 7, 'custom']
+        self.assertEqual(table['*!*@5.example'], ('other', 7, 'custom'))
+        self.assertEqual(len(strings), 4)
+        for i in range(90):
+            del table['*!*@%d.example' % i]
+        self.assertEqual(len(strings), 2)
+        self.assertEqual(list(table), ['*!*@%d.example' % i
+                                       for i in range(90, 100)])
+        self.assertEqual(table['*!*@99.example'], ('op', 1099, 'default'))
+        self.assertNotIn('*!*@5.example', table)
+        self.assertEqual(dict(table.items())['*!*@90.example'],
+                         ('op', 1090, 'default'))
+
+    def testExpiredPopsOldestFirst(self):
+        table = BanTable(StringTable())
+        for i in range(10):
+            table['*!*@%d.example' % i] = ['op', 1000 - i, 'r']
+        self.assertEqual(table.expired(993, limit=2),
+                         ['*!*@9.example', '*!*@8.example'])
+        for mask in ('*!*@9.example', '*!*@8.example'):
+            del table[mask]
+        del table['*!*@7.example']
+        table['*!*@6.example'] = ['op', 2000, 'r']  # re-added, now recent
+        table['*!*@new.example'] = ['op', 1, 'r']
+        self.assertEqual(table.expired(997),
+                         ['*!*@new.example', '*!*@5.example',
+                          '*!*@4.example'])
+
+    def testRunningAggregates(self):
+        day = 86400
+        now = 100 * day + 10
+        table = BanTable(StringTable())
+        for i in range(6):
+            table['*!*@%d.example' % i] = ['ab'[i % 2] if i < 5 else 'c',
+                                          now - i * day, 'r']
+        self.assertEqual(table.oldest(), now - 5 * day)
+        self.assertEqual(table.newest(), now)
+        self.assertEqual(table.topAdders(2), [('a', 3), ('b', 2)])
+        self.assertEqual([table.addedSince(n, now) for n in (1, 3, 30)],
+                         [1, 3, 6])
+        del table['*!*@0.example']
+        del table['*!*@5.example']
+        table['*!*@1.example'] = ['c', now - 50 * day, 'r']
+        self.assertEqual(table.oldest(), now - 50 * day)
+        self.assertEqual(table.newest(), now - 2 * day)
+        self.assertEqual(dict(table.topAdders(3)), {'a': 2, 'b': 1, 'c': 1})
+        self.assertEqual(table.addedSince(30, now), 3)
+
+    def testSnapshotIgnoresLaterWrites(self):
+        table = BanTable(StringTable())
+        for i in range(5):
+            table['*!*@%d.example' % i] = ['op', 1000 + i, 'r']
+        snapshot = table.snapshot()
+        del table['*!*@0.example']
+        table['*!*@9.example'] = ['new', 2000, 'other']
+        self.assertEqual(len(snapshot), 5)
+        self.assertIn('*!*@0.example', snapshot)
+        self.assertNotIn('*!*@9.example', snapshot)
+        self.assertEqual(snapshot['*!*@4.example'], ('op', 1004, 'r'))
+        self.assertEqual((snapshot.oldest(), snapshot.newest()), (1000, 1004))
+        self.assertEqual(snapshot.topAdders(1), [('op', 5)])
+
+
+class MaskBuilderTestCase(SupyTestCase):
+    def testTemplates(self):
+        builder = MaskBuilder(Blacklist.banmasks, size=2)
+        hostmask = 'ni-ck!~id@a-1.b.example'
+        self.assertEqual([builder.build(hostmask, num) for num in range(11)], [
+            '*!~id@a-1.b.example', '*!*~id@a-1.b.example', '*!*@a-1.b.example',
+            '*!*~id@*.b.example', '*!*@*.b.example', 'ni-ck!~id@a-1.b.example',
+            'ni-ck!*~id@a-1.b.example', 'ni-ck!*@a-1.b.example',
+            'ni-ck!*~id@*.b.example', 'ni-ck!*@*.b.example', '*!~id@*'])
+        self.assertEqual(builder.build('n!i@localhost', 4), '*!*@*.localhost')
+        self.assertEqual(builder.build('n!i@h.example', 99), '*!*@h.example')
+        self.assertEqual(len(builder._cache), 2)
+        self.assertRaises(ValueError, builder.build, 'n!@h', 2)
+
+
+class ChannelCacheTestCase(SupyTestCase):
+    def testLoadsLazilyAndEvictsLeastRecentlyUsed(self):
+        data = {'#%d' % i: {'m%d!*@*' % j: ['op', j, 'r'] for j in range(10)}
+                for i in range(5)}
+        loads = []
+        evicted = []
+
+        def loader(channel):
+            loads.append(channel)
+            return dict(data[channel])
+
+        cache = ChannelCache(loader, data, 25, onEvict=lambda channel, bans: evicted.append(channel))
+        self.assertIn('#3', cache)
+        self.assertNotIn('#9', cache)
+        self.assertEqual(loads, [])
+        for channel in ('#0', '#1', '#0', '#2'):
+            self.assertEqual(len(cache[channel]), 10)
+        self.assertEqual(loads, ['#0', '#1', '#2'])
+        self.assertEqual(evicted, ['#1'])
+        self.assertEqual(sorted(cache.loaded()), ['#0', '#2'])
+        cache.setdefault('#9', {})['x!*@*'] = ['op', 0, 'r']
+        self.assertIn('#9', cache)
+        del cache['#9']
+        self.assertNotIn('#9', cache)
+
+
+class CoalescingWriterTestCase(SupyTestCase):
+    def testBurstIsFlushedOnce(self):
+        flushes = []
+        writer = CoalescingWriter(lambda: flushes.append(time.time()),
+                                  0.05, 5)
+        for i in range(500):
+            writer.mark()
+        time.sleep(0.3)
+        self.assertEqual(len(flushes), 1)
+        writer.mark()
+        writer.stop()
+        self.assertEqual(len(flushes), 2)
+
+    def testSurvivesFlushDuringDebounce(self):
+        flushes = []
+        writer = CoalescingWriter(lambda: flushes.append(time.time()),
+                                  0.1, 5)
+        writer.mark()
+        time.sleep(0.02)
+        writer.flush()  # while the thread waits out the debounce
+        time.sleep(0.2)
+        self.assertTrue(writer._thread.is_alive())
+        self.assertEqual(len(flushes), 1)
+        writer.mark()
+        time.sleep(0.3)
+        self.assertEqual(len(flushes), 2)
+        writer.stop()
+
+
+class HistogramTestCase(SupyTestCase):
+    def testPercentilesAreBucketBounds(self):
+        histogram = Histogram()
+        for i in range(99):
+            histogram.add(0.00001)
+        histogram.add(0.5)
+        self.assertEqual(histogram.percentile(.5), 16e-6)
+        self.assertEqual(histogram.percentile(.99), 16e-6)
+        self.assertEqual(histogram.percentile(1), 0.5)
+        self.assertEqual(Histogram().percentile(.5), 0)
+
+
+class BlacklistTestCase(ChannelPluginTestCase):
+    plugins = ('Blacklist',)
+    config = {'supybot.plugins.Blacklist.enabled': True}
+
+    def setUp(self):
+        super().setUp()
+        self.irc.feedMsg(ircmsgs.op(self.channel, self.irc.nick))
+        self.cb = self.irc.getCallback('Blacklist')
+
+    def testJoinMatchesIndexedMask(self):
+        self.assertNotError('add *!*@*.spam.example lalala')
+        self.cb._modes.flush()
+        while self.irc.takeMsg():
+            pass
+        self.irc.feedMsg(ircmsgs.join(self.channel,
+                                      prefix='bot!~b@x.SPAM.example'))
+        self.cb._joins.drain()
+        self.cb._modes.flush()
+        m = self.irc.takeMsg()
+        self.assertEqual(m, ircmsgs.ban(self.channel, '*!*@*.spam.example'))
+        m = self.irc.takeMsg()
+        self.assertEqual(m, ircmsgs.kick(self.channel, 'bot', 'lalala'))
+        self.assertNotError('remove *!*@*.spam.example')
+        self.cb._modes.flush()
+        while self.irc.takeMsg():
+            pass
+        self.irc.feedMsg(ircmsgs.join(self.channel,
+                                      prefix='bot2!~b@x.spam.example'))
+        self.cb._joins.drain()
+        self.cb._modes.flush()
+        self.assertIsNone(self.irc.takeMsg())
+
+    def testReadsSeeNewViews(self):
+        self.assertNotError('add *!*@one.example')
+        version, bans = self.cb._view(self.channel)
+        self.assertEqual(list(bans), ['*!*@one.example'])
+        self.assertNotError('add *!*@two.example')
+        # Writes leave the old view in place for the next read to replace
+        self.assertIs(self.cb._views[self.channel][1], bans)
+        newVersion, newBans = self.cb._view(self.channel)
+        self.assertGreater(newVersion, version)
+        self.assertEqual(list(bans), ['*!*@one.example'])
+        self.assertEqual(sorted(newBans),
+                         ['*!*@one.example', '*!*@two.example'])
+        self.assertEqual(self.cb._lookupBan(self.channel,
+                                            '*!*@two.example')[0],
+                         self.nick)
+
+    def testLookupAfterWriteTakesNoSnapshot(self):
+        self.assertNotError('add *!*@one.example')
+        version, bans = self.cb._view(self.channel)
+        self.assertNotError('add *!*@two.example')
+        self.assertEqual(self.cb._lookupBan(self.channel,
+                                            '*!*@two.example')[0],
+                         self.nick)
+        self.assertIsNone(self.cb._lookupBan(self.channel,
+                                             '*!*@three.example'))
+        # Read from the table; the stale view is left for _view to replace
+        self.assertIs(self.cb._views[self.channel][1], bans)
+
+    def testJoinFloodIsBatched(self):
+        self.irc.state.supported['modes'] = 4
+        self.irc.state.supported['targmax'] = 'KICK:10'
+        self.assertNotError('add *!*@*.flood.example flood')
+        self.cb._modes.flush()
+        while self.irc.takeMsg():
+            pass
+        processed = self.cb._joins.processed
+        for i in range(6):
+            # Clones reconnecting from the same hosts
+            self.irc.feedMsg(ircmsgs.join(self.channel,
+                prefix='c%d!~c@%d.flood.example' % (i, i % 2)))
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='ok!~o@fine.example'))
+        self.assertTrue(self.cb._joins.drain(timeout=5))
+        self.cb._modes.flush()
+        self.assertEqual(self.irc.takeMsg(),
+                         ircmsgs.ban(self.channel, '*!*@*.flood.example'))
+        kick = self.irc.takeMsg()
+        self.assertEqual(kick.command, 'KICK')
+        self.assertEqual(sorted(kick.args[1].split(',')),
+                         ['c%d' % i for i in range(6)])
+        self.assertIsNone(self.irc.takeMsg())
+        self.assertEqual(self.cb._joins.processed - processed, 7)
+        self.assertRegexp('joinstats', '0 waiting .* 0 dropped')
+        # Matched once per banned host, whatever the nicks and idents
+        matches = self.cb._metrics.snapshot()[1]['match'].count
+        self.cb._enforceJoins([(self.irc, self.channel, 'd%d' % i,
+                                'd%d!~d%d@0.flood.example' % (i, i))
+                               for i in range(5)])
+        self.assertEqual(self.cb._metrics.snapshot()[1]['match'].count,
+                         matches + 1)
+        self.cb._modes.flush()
+        while self.irc.takeMsg():
+            pass
+
+    def testDroppedJoinsAreEnforcedAfterTheBurst(self):
+        self.assertNotError('add *!*@*.flood.example flood')
+        self.cb._modes.flush()
+        while self.irc.takeMsg():
+            pass
+        release = threading.Event()
+        process = self.cb._joins._process
+        self.cb._joins._process = lambda joins: release.wait(5) and process(joins)
+        self.cb._joins.maxsize = 2
+        for i in range(6):
+            self.irc.feedMsg(ircmsgs.join(self.channel,
+                prefix='c%d!~c@%d.flood.example' % (i, i % 2)))
+        self.assertGreaterEqual(self.cb._joins.dropped, 3)
+        release.set()
+        self.assertTrue(self.cb._joins.drain(timeout=5))
+        self.cb._modes.flush()
+        kicked = set()
+        msg = self.irc.takeMsg()
+        while msg is not None:
+            if msg.command == 'KICK':
+                kicked.update(msg.args[1].split(','))
+            msg = self.irc.takeMsg()
+        self.assertEqual(kicked, {'c%d' % i for i in range(6)})
+        self.assertEqual(self.cb._overflow, {})
+
+    def testMetricsCountJoinsBansAndWrites(self):
+        self.assertNotError('add *!*@*.spam.example')
+        self.cb._writer.flush()
+        self.irc.feedMsg(ircmsgs.join(self.channel,
+                                      prefix='bot!~b@x.spam.example'))
+        self.irc.feedMsg(ircmsgs.join(self.channel,
+                                      prefix='ok!~o@fine.example'))
+        self.assertTrue(self.cb._joins.drain(timeout=5))
+        self.cb._modes.flush()
+        counters, histograms = self.cb._metrics.snapshot()
+        self.assertEqual((counters['checked'], counters['matched'],
+                          counters['bans']), (2, 1, 1))
+        self.assertEqual(histograms['match'].count, 2)
+        self.assertGreater(counters['writeBytes'], 0)
+        while self.irc.takeMsg():
+            pass
+        self.assertRegexp('metrics', r'2 checked, 1 matched.* Writes: [1-9]')
+
+    def testDueUnbansAreGroupedAndPersisted(self):
+        self.irc.state.supported['modes'] = 3
+        masks = ['*!*@%d.example' % i for i in range(5)]
+        for mask in masks:
+            self.cb._scheduleExpiry('unban', self.irc, self.channel, mask, -1)
+        self.cb._scheduleExpiry('unban', self.irc, self.channel,
+                                '*!*@later.example', 3600)
+        self.cb._writer.flush()
+        saved = [key[3] for key, when in self.cb._loadTimers()]
+        self.assertEqual(sorted(saved), sorted(masks + ['*!*@later.example']))
+        self.cb._expiryTick()
+        self.cb._modes.flush()
+        self.assertEqual(self.irc.takeMsg(),
+                         ircmsgs.unbans(self.channel, masks[:3]))
+        self.assertEqual(self.irc.takeMsg(),
+                         ircmsgs.unbans(self.channel, masks[3:]))
+        self.assertIsNone(self.irc.takeMsg())
+        self.cb._writer.flush()
+        self.assertEqual([key[3] for key, when in self.cb._loadTimers()],
+                         ['*!*@later.example'])
+
+    def testBansAndKicksArePacked(self):
+        self.irc.state.supported['modes'] = 4
+        self.irc.state.supported['targmax'] = 'NAMES:1,KICK:2,WHOIS:1'
+        for i in range(5):
+            self.cb._modes.ban(self.irc, self.channel, '*!*@%d.example' % i)
+        for nick in ('a', 'b', 'c', 'a'):
+            self.cb._modes.kick(self.irc, self.channel, nick, 'bye')
+        self.cb._modes.kick(self.irc, self.channel, 'd', 'other')
+        self.cb._modes.flush()
+        msgs = []
+        m = self.irc.takeMsg()
+        while m:
+            msgs.append(m)
+            m = self.irc.takeMsg()
+        self.assertEqual(msgs, [
+            ircmsgs.bans(self.channel, ['*!*@%d.example' % i
+                                        for i in range(4)]),
+            ircmsgs.bans(self.channel, ['*!*@4.example']),
+            ircmsgs.kicks(self.channel, ['a', 'b'], 'bye'),
+            ircmsgs.kicks(self.channel, ['c'], 'bye'),
+            ircmsgs.kicks(self.channel, ['d'], 'other'),
+        ])
+
+    def testEnforceKicksMatchingMembersAtKickRate(self):
+        self.irc.state.supported['targmax'] = 'KICK:1'
+        for i in range(4):
+            host = 'bad.example' if i % 2 else 'good.example'
+            self.irc.feedMsg(ircmsgs.join(self.channel,
+                                          prefix='u%d!~u@%d.%s' % (i, i, host)))
+        self.cb._joins.drain()
+        while self.irc.takeMsg():
+            pass
+        self.cb._db_set(self.channel, '*!*@*.BAD.example',
+                        ['op', time.time(), 'go away'])
+        ban = ircmsgs.ban(self.channel, '*!*@*.BAD.example')
+        self.cb._modes.kickBurst = 1
+        try:
+            self.assertRegexp('blacklist enforce', '1 banmasks')
+            self.cb._modes.flush((self.irc.network, self.channel))
+            self.assertEqual(self.irc.takeMsg(), ban)
+            kicked = [self.irc.takeMsg().args[1]]
+            self.assertIsNone(self.irc.takeMsg())
+            self.cb._modes.flush()
+            kicked.append(self.irc.takeMsg().args[1])
+            self.assertEqual(sorted(kicked), ['u1', 'u3'])
+            # The member table follows nick changes and parts
+            self.irc.feedMsg(ircmsgs.nick('u5', prefix='u1!~u@1.bad.example'))
+            self.irc.feedMsg(ircmsgs.part(self.channel,
+                                          prefix='u3!~u@3.bad.example'))
+            self.assertRegexp('blacklist enforce', '1 banmasks')
+            self.cb._modes.flush()
+            self.assertEqual(self.irc.takeMsg(),
+                             ircmsgs.kick(self.channel, 'u5', 'go away'))
+            self.assertIsNone(self.irc.takeMsg())
+        finally:
+            self.cb._modes.kickBurst = None
+
+    def testDeferredKickKeepsEmptyReason(self):
+        self.irc.state.supported['targmax'] = 'KICK:1'
+        key = (self.irc.network, self.channel)
+        self.cb._modes.kickBurst = 1
+        try:
+            for nick in ('a', 'b'):
+                self.cb._modes.kick(self.irc, self.channel, nick, '')
+            self.cb._modes.flush(key)
+            self.assertEqual(self.irc.takeMsg().args, (self.channel, 'a'))
+            self.assertIsNone(self.irc.takeMsg())
+            self.cb._modes.flush()
+            self.assertEqual(self.irc.takeMsg().args, (self.channel, 'b'))
+        finally:
+            self.cb._modes.kickBurst = None
+
+    def testMemberTableIgnoresChannelCase(self):
+        upper = self.channel.upper()
+        members = self.cb._memberTable(self.irc, upper)
+        self.irc.feedMsg(ircmsgs.join(self.channel,
+                                      prefix='late!~l@late.example'))
+        self.assertIs(self.cb._memberTable(self.irc, self.channel), members)
+        self.assertIn('late', members)
+
+    def testImportExportAndSync(self):
+        datadir = os.path.dirname(self.cb.dbfile)
+        os.makedirs(datadir, exist_ok=True)
+        with open(os.path.join(datadir, 'bans.jsonl'), 'w') as fd:
+            fd.write(json.dumps({'mask': '*!*@a.example', 'adder': 'x',
+                                 'timestamp': 1000, 'reason': 'r'}) + '\n')
+            fd.write(json.dumps({'mask': 'not a mask'}) + '\n')
+            fd.write('\n' + json.dumps({'mask': '*!*@b.example'}) + '\n')
+            fd.write('{"mask": "*!*@c.example", truncated\n')
+            fd.write(json.dumps({'mask': '*!*@d.example', 'adder': {'x': 1}}) + '\n')
+            fd.write(json.dumps({'mask': '*!*@e.example', 'reason': ['r']}) + '\n')
+            fd.write(json.dumps({'mask': '*!*@f.example', 'timestamp': 'inf'}) + '\n')
+        self.assertRegexp('blacklist import bans.jsonl',
+                          r'Imported 2 bans .* \(5 invalid skipped\)')
+        self.assertRegexp('blacklist import ../bans.jsonl', 'plain file name')
+        with self.cb._get_db() as db:
+            self.assertEqual(db[self.channel]['*!*@a.example'], ('x', 1000, 'r'))
+            self.assertEqual(db[self.channel]['*!*@b.example'][0], 'test')
+        self.assertRegexp('blacklist export bans.csv', 'Exported 2 bans')
+        self.assertRegexp('blacklist import #other bans.csv', 'Imported 2 bans')
+        with self.cb._get_db() as db:
+            self.assertEqual(dict(db['#other'].items()),
+                             dict(db[self.channel].items()))
+        self.irc.state.channels[self.channel].bans.update(
+            ['*!*@a.example', '*!*@c.example', '$a:account'])
+        self.assertRegexp('blacklist sync', 'Added 1 of the 3 bans')
+        with self.cb._get_db() as db:
+            self.assertEqual(len(db[self.channel]), 3)
+
+    def testSweepRemovesExpiredBansWithinBudget(self):
+        old = time.time() - 400 * 60
+        for i in range(5):
+            self.cb._db_set(self.channel, '*!*@%d.example' % i, ['op', old + i, 'r'])
+        self.cb._db_set(self.channel, '*!*@fresh.example', ['op', time.time(), 'r'])
+        self.cb._expirySweep()
+        with self.cb._get_db() as db:
+            self.assertEqual(len(db[self.channel]), 6)  # autoCleanup is off
+        self.cb.sweepBudget = 3
+        try:
+            with conf.supybot.plugins.Blacklist.autoCleanup.context(True):
+                self.cb._expirySweep()
+                with self.cb._get_db() as db:
+                    self.assertEqual(list(db[self.channel]),
+                                     ['*!*@3.example', '*!*@4.example',
+                                      '*!*@fresh.example'])
+                self.cb._expirySweep()
+        finally:
+            del self.cb.sweepBudget
+        with self.cb._get_db() as db:
+            self.assertEqual(list(db[self.channel]), ['*!*@fresh.example'])
+
+    def testSweepLoadsUnloadedChannels(self):
+        old = time.time() - 400 * 60
+        for channel in ('#a', '#b'):
+            self.cb._db_setMany(channel, [('*!*@%d.example' % i, ['op', old, 'r'])
+                                          for i in range(2)])
+            self.cb._db_set(channel, '*!*@fresh.example', ['op', time.time(), 'r'])
+        self.cb._dbWrite()
+        self.cb._writer.flush()
+        with self.cb._get_db() as db:
+            db.unload('#a')
+            db.unload('#b')
+        self.cb.sweepLoads = 1
+        try:
+            with conf.supybot.plugins.Blacklist.autoCleanup.context(True):
+                self.cb._expirySweep()
+                with self.cb._get_db() as db:
+                    self.assertEqual(db.loaded(), [])
+                    self.assertEqual(len(db['#a']), 1)
+                    db.unload('#a')
+                    self.assertIsNone(db.peek('#b'))
+                self.cb._expirySweep()
+                with self.cb._get_db() as db:
+                    self.assertEqual(list(db['#b']), ['*!*@fresh.example'])
+        finally:
+            del self.cb.sweepLoads
+
+    def testSweepReadsUnloadedChannelsWithoutTheLock(self):
+        old = time.time() - 400 * 60
+        self.cb._db_setMany('#a', [('*!*@%d.example' % i, ['op', old, 'r'])
+                                   for i in range(3)])
+        self.cb._db_set('#a', '*!*@fresh.example', ['op', time.time(), 'r'])
+        self.cb._dbWrite()
+        self.cb._writer.flush()
+        with self.cb._get_db() as db:
+            db.unload('#a')
+        self.cb._oldest.clear()  # as after a restart
+        loads = []
+        loadChannel = self.cb._store.loadChannel
+        self.cb._store.loadChannel = \
+            lambda c: loads.append(self.cb._depth) or loadChannel(c)
+        with conf.supybot.plugins.Blacklist.autoCleanup.context(True):
+            self.cb._expirySweep()
+            self.assertEqual(loads, [0])
+            # Its oldest ban is now known to be fresh
+            self.cb._expirySweep()
+            self.assertEqual(loads, [0])
+        with self.cb._get_db() as db:
+            self.assertIsNone(db.peek('#a'))
+            self.assertEqual(list(db['#a']), ['*!*@fresh.example'])
+
+    def testSubscribedBanSetsAreMatchedOnJoin(self):
+        self.assertNotError('setadd spam *!*@*.spam.example spammer')
+        self.assertNotError('setadd spam *!*@other.example')
+        self.assertNotError('setadd drones *!*@*.spam.example drone')
+        self.assertRegexp('setlist', 'drones \\(1\\), spam \\(2\\)')
+        self.assertNotError('subscribe spam')
+        self.assertNotError('subscribe drones')
+        self.assertNotError('add *!*@local.example')
+        self.cb._modes.flush()
+        while self.irc.takeMsg():
+            pass
+        self.irc.feedMsg(ircmsgs.join(self.channel,
+                                      prefix='bot!~b@x.spam.example'))
+        self.cb._joins.drain()
+        self.cb._modes.flush()
+        self.assertEqual(self.irc.takeMsg(),
+                         ircmsgs.ban(self.channel, '*!*@*.spam.example'))
+        self.assertEqual(self.irc.takeMsg(),
+                         ircmsgs.kick(self.channel, 'bot', 'drone'))
+        with self.cb._get_db():
+            drones, spam = self.cb._matchers(self.channel)[1:]
+            self.assertIs(drones, self.cb._setMatcher('@drones'))
+            self.assertEqual(len(drones), 1)
+            self.assertEqual(len(spam), 2)
+        self.assertNotError('setremove spam *!*@*.spam.example')
+        self.assertNotIn('*!*@*.spam.example', spam)
+        self.assertIn('*!*@*.spam.example', drones)
+        self.assertNotError('setremove drones *!*@*.spam.example')
+        self.assertNotIn('*!*@*.spam.example', drones)
+        # A set's matcher goes once no channel subscribes to it
+        self.assertNotError('unsubscribe spam')
+        self.assertEqual(list(self.cb._setMatchers), ['@drones'])
+        self.assertNotError('unsubscribe drones')
+        self.assertEqual(self.cb._setMatchers, {})
+        self.assertError('unsubscribe drones')
+        self.assertRegexp('subscribe typo', 'empty or does not exist')
+        self.assertRegexp('setlist', 'Error: .*admin capability',
+                          frm='stranger!s@__no_testcap__')
+
+    def testListExportRunsInBackgroundAndIsCached(self):
+        uploads = []
+
+        class PasteHandler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                uploads.append(json.loads(body)['content'])
+                reply = json.dumps({'data': {'key': 'k%d' % len(uploads)}})
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(reply.encode('utf-8'))
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), PasteHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.cb.pasteApiUrl = 'http://127.0.0.1:%d/' % server.server_port
+        try:
+            for i in range(3):
+                self.cb._db_set(self.channel, '*!*@%d.example' % i,
+                                ('op', time.time(), 'spam'))
+            with conf.supybot.plugins.Blacklist.maxInlineEntries.context(2):
+                self.assertRegexp('blacklist list', r'View at: https://pastes.io/raw/k1')
+                self.assertIn('Mask: *!*@2.example', uploads[0])
+                self.assertRegexp('blacklist list', r'View at: https://pastes.io/raw/k1')
+                self.assertEqual(len(uploads), 1)
+                self.cb._db_del(self.channel, '*!*@0.example')
+                self.cb._db_set(self.channel, '*!*@3.example',
+                                ('op', time.time(), 'spam'))
+                self.assertRegexp('blacklist list', r'View at: https://pastes.io/raw/k2')
+                self.assertNotIn('0.example', uploads[1])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def testListPagesArePackedAndFiltered(self):
+        now = time.time()
+        for i in range(30):
+            adder = 'alice' if i % 3 else 'bob'
+            self.cb._db_set(self.channel, '*!*@%02d.example' % i,
+                            (adder, now - i * 120, 'spam'))
+        with conf.supybot.plugins.Blacklist.pageLines.context(1):
+            seen = []
+            page = 1
+            while True:
+                m = self.getMsg('blacklist list --page %d' % page)
+                if 'no page' in m.args[1]:
+                    break
+                self.assertLessEqual(len(m.args[1].encode('utf-8')), 450)
+                seen.extend(entry.split()[0] for entry in
+                            m.args[1].split(' | '))
+                more = self.irc.takeMsg()
+                page += 1
+                if more is None:
+                    break
+                self.assertIn('--page %d' % page, more.args[1])
+            self.assertEqual(seen, ['*!*@%02d.example' % i
+                                    for i in range(30)])
+            self.assertGreater(page, 2)
+        self.assertRegexp('blacklist list --adder BOB --since 10',
+                          r'\*!\*@00\.example - Added by bob .*'
+                          r' \| \*!\*@03\.example [^|]*$')
+
+
+class BlacklistSqliteTestCase(ChannelPluginTestCase):
+    plugins = ('Blacklist',)
+    config = {'supybot.plugins.Blacklist.enabled': True,
+              'supybot.plugins.Blacklist.storage': 'sqlite'}
+
+    def setUp(self):
+        super().setUp()
+        # config is applied after the plugin is loaded; reload it so it
+        # opens the SQLite store
+        self.assertNotError('reload Blacklist')
+        self.irc.feedMsg(ircmsgs.op(self.channel, self.irc.nick))
+        self.cb = self.irc.getCallback('Blacklist')
+        self.assertTrue(self.cb._store.indexed)
+
+    def testCleanupAndStats(self):
+        self.assertNotError('add *!*@fresh.example')
+        while self.irc.takeMsg():
+            pass
+        self.cb._db_set(self.channel, '*!*@stale.example',
+                        ['op', time.time() - 10**6, 'old'])
+        self.cb._dbWrite()
+        self.cb._views.clear()
+        self.assertRegexp('stats', '2 total.*Top adders: test \\(1\\), op \\(1\\)')
+        # Read from the table's aggregates, not from a snapshot
+        self.assertNotIn(self.channel, self.cb._views)
+        self.assertResponse('cleanup',
+                            f'Removed 1 expired bans from {self.channel}.')
+        self.assertRegexp('stats', '1 total')
+        self.assertNotIn('*!*@stale.example', self.cb.db[self.channel])
+
+    def testCleanupUnloadedChannel(self):
+        self.cb._db_setMany(self.channel, [
+            ('*!*@stale%d.example' % i, ['op', time.time() - 10**6, 'old'])
+            for i in range(3)])
+        self.cb._dbWrite()
+        self.cb._writer.flush()
+        with self.cb._get_db() as db:
+            db.unload(self.channel)
+        self.assertEqual(len(self.cb._cleanup(self.channel)), 3)
+
+    def testSweepSkipsUnloadedChannelsWithNothingExpired(self):
+        self.cb._db_set('#fresh', '*!*@fresh.example', ['op', time.time(), 'r'])
+        self.cb._db_set('#stale', '*!*@stale.example', ['op', 1, 'r'])
+        self.cb._dbWrite()
+        self.cb._writer.flush()
+        with self.cb._get_db() as db:
+            db.unload('#fresh')
+            db.unload('#stale')
+        loads = []
+        loadChannel = self.cb._store.loadChannel
+        self.cb._store.loadChannel = lambda c: loads.append(c) or loadChannel(c)
+        with conf.supybot.plugins.Blacklist.autoCleanup.context(True):
+            self.cb._expirySweep()
+        self.assertEqual(loads, ['#stale'])
+        self.assertNotIn('#stale', self.cb.db)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
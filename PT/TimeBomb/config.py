@@ -151,14 +151,6 @@ conf.registerChannelValue(
     ),
 )
 
-conf.registerChannelValue(
-    TimeBomb,
-    "bombHistory",
-    registry.SpaceSeparatedListOfStrings(
-        [], """Data e hora, remetentes e vítimas de bombas anteriores no canal."""
-    ),
-)
-
 conf.registerChannelValue(
     TimeBomb,
     "rateLimitTime",
@@ -28,6 +28,10 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import collections
+import json
+import os
+import threading
 import time
 import string
 import random
@@ -45,12 +49,138 @@ import supybot.registry as registry
 import supybot.conf as conf
 
 
+class BombHistory:
+    """Recent bombs of every channel, kept for the rate limits.
+
+    Each channel has a deque of (timestamp, sender mask, victim) in the
+    order the bombs were thrown, plus running counts per sender and per
+    victim, so a check only pops what has expired and reads two counters.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}  # channel -> (deque, sender Counter, victim Counter)
+        self.dirty = False
+
+    def expire(self, channel, cutoff):
+        """Forget the bombs of <channel> thrown before <cutoff>."""
+        with self.lock:
+            self._expire(channel, cutoff)
+
+    def _expire(self, channel, cutoff):
+        state = self.channels.get(channel)
+        if state is None:
+            return None
+        bombs, senders, victims = state
+        while bombs and bombs[0][0] < cutoff:
+            when, sender, victim = bombs.popleft()
+            for counter, key in ((senders, sender), (victims, victim)):
+                counter[key] -= 1
+                if not counter[key]:
+                    del counter[key]
+            self.dirty = True
+        if not bombs:
+            del self.channels[channel]
+            return None
+        return state
+
+    def counts(self, channel, sender, victim, cutoff):
+        """Return how many bombs were thrown in <channel> since <cutoff>:
+        in total, by <sender> and at <victim>."""
+        with self.lock:
+            state = self._expire(channel, cutoff)
+            if state is None:
+                return 0, 0, 0
+            bombs, senders, victims = state
+            return len(bombs), senders[sender], victims[victim]
+
+    def victimsOver(self, channel, limit, cutoff):
+        """Return the victims bombed more than <limit> times in <channel>
+        since <cutoff>."""
+        with self.lock:
+            state = self._expire(channel, cutoff)
+            if state is None:
+                return set()
+            return {victim for victim, count in state[2].items() if count > limit}
+
+    def add(self, channel, when, sender, victim):
+        with self.lock:
+            state = self.channels.get(channel)
+            if state is None:
+                state = self.channels[channel] = (
+                    collections.deque(),
+                    collections.Counter(),
+                    collections.Counter(),
+                )
+            bombs, senders, victims = state
+            bombs.append((when, sender, victim))
+            senders[sender] += 1
+            victims[victim] += 1
+            self.dirty = True
+
+    def dump(self):
+        """Return {channel: [[timestamp, sender, victim], ...]} and mark
+        the history as saved."""
+        with self.lock:
+            self.dirty = False
+            return {
+                channel: [list(bomb) for bomb in state[0]]
+                for channel, state in self.channels.items()
+            }
+
+
+class ActivityTracker:
+    """When each nick last spoke, per channel.
+
+    Every channel keeps an OrderedDict from folded nick to (nick, time) in
+    the order they last spoke, so who has been active recently is read from
+    its end and stale entries are dropped from its front.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}  # channel -> OrderedDict(folded nick -> (nick, time))
+
+    def touch(self, channel, nick, when):
+        key = ircutils.toLower(nick)
+        with self.lock:
+            speakers = self.channels.get(channel)
+            if speakers is None:
+                speakers = self.channels[channel] = collections.OrderedDict()
+            speakers[key] = (nick, when)
+            speakers.move_to_end(key)
+
+    def since(self, channel, cutoff):
+        """Return the nicks that spoke in <channel> after <cutoff>, most
+        recent first."""
+        nicks = []
+        with self.lock:
+            for nick, when in reversed(self.channels.get(channel, {}).values()):
+                if when <= cutoff:
+                    break
+                nicks.append(nick)
+        return nicks
+
+    def expire(self, channel, cutoff):
+        """Forget who last spoke in <channel> before <cutoff>."""
+        with self.lock:
+            speakers = self.channels.get(channel)
+            if speakers is None:
+                return
+            while speakers and next(iter(speakers.values()))[1] <= cutoff:
+                speakers.popitem(last=False)
+            if not speakers:
+                del self.channels[channel]
+
+
 class TimeBomb(callbacks.Plugin):
     """
     Mais um plugin de bomba-relógio.
     """
 
     threaded = True
+    saveInterval = 60  # seconds between two saves of the bomb history
+    pruneInterval = 60  # seconds between two sweeps of stale activity
 
     def __init__(self, irc):
         self.__parent = super(TimeBomb, self)
@@ -58,17 +188,148 @@ class TimeBomb(callbacks.Plugin):
         self.rng = random.Random()
         self.rng.seed()
         self.bombs = {}
+        self.locks = {}
         self.lastBomb = ""
-        self.talktimes = {}
+        self.activity = ActivityTracker()
+        self.historyFile = conf.supybot.directories.data.dirize("TimeBomb.json")
+        self.history = BombHistory()
+        self._loadHistory()
+        schedule.addPeriodicEvent(
+            self._saveHistory, self.saveInterval, name="TimeBomb_history", now=False
+        )
+        schedule.addPeriodicEvent(
+            self._pruneActivity,
+            self.pruneInterval,
+            name="TimeBomb_activity",
+            now=False,
+        )
+
+    def die(self):
+        for name in ("TimeBomb_history", "TimeBomb_activity"):
+            try:
+                schedule.removePeriodicEvent(name)
+            except KeyError:
+                pass
+        self._saveHistory()
+        self.__parent.die()
+
+    def _pruneActivity(self):
+        """Forget speakers idle for longer than their channel's idleTime."""
+        now = time.time()
+        for channel in list(self.activity.channels):
+            self.activity.expire(
+                channel, now - self.registryValue("idleTime", channel) * 60
+            )
+
+    def _loadHistory(self):
+        try:
+            with open(self.historyFile) as fd:
+                data = json.load(fd)
+            for channel, bombs in data.items():
+                for when, sender, victim in bombs:
+                    self.history.add(channel, float(when), sender, victim)
+        except FileNotFoundError:
+            self._importRegistryHistory()
+            return
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            # A damaged file must not stop the plugin from loading; start
+            # over with an empty history
+            self.history = BombHistory()
+            self.log.warning(
+                "TimeBomb: Não consegui ler {}: {}".format(self.historyFile, e)
+            )
+            return
+        self.history.dirty = False
+
+    def _importRegistryHistory(self):
+        """Bring in the bombs of the old bombHistory registry value, kept as
+        "timestamp#sender mask#victim" strings. Only runs while there is no
+        TimeBomb.json; the next save writes one, so it happens once."""
+        prefix = "supybot.plugins.TimeBomb.bombHistory."
+        bombs = []
+        for key, value in list(registry._cache.items()):
+            if not key.lower().startswith(prefix.lower()):
+                continue
+            channel = key[len(prefix) :]
+            if channel.startswith(":"):
+                # Network specific value, ":network.#channel"
+                channel = channel.split(".", 1)[-1]
+            for bomb in value.split():
+                parts = bomb.split("#")
+                if len(parts) < 3:
+                    continue
+                try:
+                    when = float(parts[0])
+                except ValueError:
+                    continue
+                bombs.append((when, channel, parts[1], parts[2]))
+        # The history expects every channel's bombs in throw order
+        for when, channel, sender, victim in sorted(bombs):
+            self.history.add(channel, when, sender, victim)
+        if bombs:
+            self.log.info(
+                "TimeBomb: Importei {} bombas do registo antigo.".format(len(bombs))
+            )
+
+    def _saveHistory(self):
+        """Drop expired bombs and write the history out if it changed."""
+        now = time.time()
+        for channel in list(self.history.channels):
+            self.history.expire(
+                channel, now - self.registryValue("rateLimitTime", channel)
+            )
+        if not self.history.dirty:
+            return
+        data = self.history.dump()
+        tmpfile = self.historyFile + ".tmp"
+        try:
+            with open(tmpfile, "w") as fd:
+                json.dump(data, fd)
+            os.replace(tmpfile, self.historyFile)
+        except OSError as e:
+            self.history.dirty = True
+            self.log.warning(
+                "TimeBomb: Não consegui gravar {}: {}".format(self.historyFile, e)
+            )
 
     def doPrivmsg(self, irc, msg):
-        self.talktimes[msg.nick] = time.time()
+        channel = msg.args[0]
+        if irc.isChannel(channel):
+            self.activity.touch(ircutils.toLower(channel), msg.nick, time.time())
 
     def doJoin(self, irc, msg):
-        if self.registryValue("joinIsActivity", msg.args[0]):
-            self.talktimes[msg.nick] = time.time()
+        channel = msg.args[0]
+        if self.registryValue("joinIsActivity", channel):
+            self.activity.touch(ircutils.toLower(channel), msg.nick, time.time())
 
     class Bomb:
+        """A single game, moved along by the commands and by its scheduled
+        events. Every transition happens under the channel's lock, which
+        the plugin hands in along with its shared random generator."""
+
+        # ARMED: the victim must cut a wire. THROWN: the bomb was thrown
+        # back and the new victim may only duck. DEFUSED and EXPLODED are
+        # final.
+        ARMED, THROWN, DEFUSED, EXPLODED = range(4)
+
+        __slots__ = (
+            "irc",
+            "victim",
+            "wires",
+            "detonateTime",
+            "goodWire",
+            "channel",
+            "sender",
+            "showArt",
+            "showCorrectWire",
+            "debug",
+            "rng",
+            "lock",
+            "state",
+            "command_char",
+            "cutWire",
+        )
+
         def __init__(
             self,
             irc,
@@ -81,23 +342,23 @@ class TimeBomb(callbacks.Plugin):
             showArt,
             showCorrectWire,
             debug,
+            rng,
+            lock,
         ):
             self.victim = victim
             self.detonateTime = detonateTime
             self.wires = wires
             self.goodWire = goodWire
-            self.active = True
             self.channel = channel
             self.sender = sender
             self.irc = irc
             self.showArt = showArt
             self.showCorrectWire = showCorrectWire
             self.debug = debug
-            self.thrown = False
-            self.rethrown = False
-            self.responded = False
-            self.rng = random.Random()
-            self.rng.seed()
+            self.rng = rng
+            self.lock = lock
+            self.state = self.ARMED
+            self.cutWire = None
 
             def get(group):
                 v = group.getSpecific(channel=channel)
@@ -110,11 +371,8 @@ class TimeBomb(callbacks.Plugin):
             if self.debug:
                 self.irc.reply("Acabei de criar uma bomba em {}.".format(channel))
 
-            def detonate():
-                self.detonate(irc)
-
             schedule.addEvent(
-                detonate,
+                self._timeout,
                 time.time() + self.detonateTime,
                 "{}_bomb".format(self.channel),
             )
@@ -137,25 +395,60 @@ class TimeBomb(callbacks.Plugin):
             )
 
             if self.victim == irc.nick:
-                time.sleep(1)
-                cutWire = self.rng.choice(self.wires)
-                self.irc.queueMsg(
-                    ircmsgs.privmsg(self.channel, "$cutwire {}".format(cutWire))
-                )
-                time.sleep(1)
-                self.cutwire(self.irc, cutWire)
+                # The bot takes its turn from the scheduler, a second to
+                # pick a wire and another to cut it, so nothing sleeps
+                self.cutWire = self.rng.choice(self.wires)
+                schedule.addEvent(self._announceCut, time.time() + 1)
+
+        @property
+        def active(self):
+            return self.state == self.ARMED or self.state == self.THROWN
+
+        def _timeout(self):
+            with self.lock:
+                if not self.active:
+                    return
+                # Only a victim who never got to cut a wire is invited back
+                reinvite = self.state == self.ARMED
+                self.detonate(self.irc)
+                if reinvite:
+                    schedule.addEvent(self._reinvite, time.time() + 5)
+
+        def _announceCut(self):
+            with self.lock:
+                if self.state == self.ARMED:
+                    self.irc.queueMsg(
+                        ircmsgs.privmsg(
+                            self.channel, "$cutwire {}".format(self.cutWire)
+                        )
+                    )
+                    schedule.addEvent(self._cut, time.time() + 1)
+
+        def _cut(self):
+            with self.lock:
+                if self.state == self.ARMED:
+                    self.cutwire(self.irc, self.cutWire)
+
+        def _cancel(self):
+            try:
+                schedule.removeEvent("{}_bomb".format(self.channel))
+            except KeyError:
+                # Already popped by the scheduler, whose _timeout will
+                # find the bomb no longer active
+                pass
 
         def defuse(self):
             if not self.active:
                 return
 
-            self.active = False
-            self.thrown = False
-            schedule.removeEvent("{}_bomb".format(self.channel))
+            self.state = self.DEFUSED
+            self._cancel()
 
         def cutwire(self, irc, cutWire):
+            if self.state != self.ARMED:
+                return
+
             self.cutWire = cutWire
-            self.responded = True
             specialWires = False
 
             if self.rng.randint(1, len(self.wires)) == 1:
@@ -205,8 +498,7 @@ class TimeBomb(callbacks.Plugin):
                     tmp = self.victim
                     self.victim = self.sender
                     self.sender = tmp
-                    self.thrown = True
-                    self.rethrown = True
+                    self.state = self.THROWN
                     schedule.rescheduleEvent(
                         "{}_bomb".format(self.channel), time.time() + 10
                     )
@@ -216,11 +508,11 @@ class TimeBomb(callbacks.Plugin):
                 else:
                     self.defuse()
             else:
-                schedule.removeEvent("{}_bomb".format(self.channel))
+                self._cancel()
                 self.detonate(irc)
 
         def duck(self, irc, ducker):
-            if self.thrown and ircutils.nickEqual(self.victim, ducker):
+            if self.state == self.THROWN and ircutils.nickEqual(self.victim, ducker):
                 self.irc.queueMsg(
                     ircmsgs.privmsg(
                         self.channel,
@@ -231,8 +523,10 @@ class TimeBomb(callbacks.Plugin):
                 self.defuse()
 
         def detonate(self, irc):
-            self.active = False
-            self.thrown = False
+            if not self.active:
+                return
+
+            self.state = self.EXPLODED
             if self.showCorrectWire:
                 self.irc.sendMsg(
                     ircmsgs.privmsg(
@@ -318,12 +612,49 @@ class TimeBomb(callbacks.Plugin):
             else:
                 self.irc.queueMsg(ircmsgs.kick(self.channel, self.victim, "BOOM!"))
 
-            def reinvite():
-                if self.victim not in irc.state.channels[self.channel].users:
-                    self.irc.queueMsg(ircmsgs.invite(self.victim, self.channel))
-
-            if not self.responded:
-                schedule.addEvent(reinvite, time.time() + 5)
+        def _reinvite(self):
+            if self.victim not in self.irc.state.channels[self.channel].users:
+                self.irc.queueMsg(ircmsgs.invite(self.victim, self.channel))
+
+    def _lock(self, channel):
+        """Return the lock guarding the bomb of <channel>, made on first use
+        and then kept for every later game there."""
+        lock = self.locks.get(channel)
+        if lock is None:
+            lock = self.locks.setdefault(channel, threading.Lock())
+        return lock
+
+    def _bombActive(self, irc, channel):
+        bomb = self.bombs.get(channel)
+        if bomb is not None and bomb.active:
+            irc.reply(
+                "Já existe uma bomba ativa, nas calças de {}!".format(bomb.victim)
+            )
+            return True
+        return False
+
+    def _startBomb(self, irc, channel, sender, victim, wires, detonateTime, goodWire):
+        """Arm a bomb in <channel> unless another command armed one while
+        this one was choosing; returns whether it did."""
+        with self._lock(channel):
+            if self._bombActive(irc, channel):
+                return False
+            self._logBomb(irc, channel, sender, victim)
+            self.bombs[channel] = self.Bomb(
+                irc,
+                victim,
+                wires,
+                detonateTime,
+                goodWire,
+                channel,
+                sender,
+                self.registryValue("showArt", channel),
+                self.registryValue("showCorrectWire", channel),
+                self.registryValue("debug"),
+                self.rng,
+                self._lock(channel),
+            )
+            return True
 
     def _canBomb(self, irc, channel, sender, victim, replyError):
         if sender.lower() in self.registryValue("exclusions", channel):
@@ -342,31 +673,13 @@ class TimeBomb(callbacks.Plugin):
                     )
                 )
             return False
-        bombHistoryOrig = self.registryValue("bombHistory", channel)
-        bombHistory = []
-        senderHostmask = irc.state.nickToHostmask(sender)
-        (nick, user, host) = ircutils.splitHostmask(senderHostmask)
-        senderMask = ("{}@{}".format(user, host)).lower()
-        victim = victim.lower()
-        now = int(time.time())
         storeTime = self.registryValue("rateLimitTime", channel)
-        victimCount = 0
-        senderCount = 0
-        totalCount = 0
-
-        for bstr in bombHistoryOrig:
-            b = bstr.split("#")
-            if len(b) < 3 or int(b[0]) + storeTime < now:
-                continue
-            totalCount += 1
-
-            if b[1] == senderMask:
-                senderCount += 1
-
-            if b[2] == victim:
-                victimCount += 1
-            bombHistory.append(bstr)
-        self.setRegistryValue("bombHistory", bombHistory, channel)
+        (totalCount, senderCount, victimCount) = self.history.counts(
+            channel,
+            self._senderMask(irc, sender),
+            victim.lower(),
+            int(time.time()) - storeTime,
+        )
 
         if (
             totalCount
@@ -403,14 +716,42 @@ class TimeBomb(callbacks.Plugin):
             return False
         return True
 
-    def _logBomb(self, irc, channel, sender, victim):
-        bombHistory = self.registryValue("bombHistory", channel)
+    def _victimsOverLimit(self, channel):
+        """Return the (lowercased) nicks that have been bombed too often to
+        be bombed again now."""
+        storeTime = self.registryValue("rateLimitTime", channel)
+        return self.history.victimsOver(
+            channel,
+            storeTime * self.registryValue("rateLimitVictim", channel) / 3600,
+            int(time.time()) - storeTime,
+        )
+
+    def _eligibleVictims(self, channel, nicks, overLimit):
+        """Return the nicks of <nicks> that may be bombed at random now.
+
+        The sender side of _canBomb is the same for every victim, so callers
+        check it once and read the history once for <overLimit>; everyone is
+        then filtered with set lookups."""
+        excluded = overLimit.union(
+            nick.lower()
+            for name in ("randomExclusions", "exclusions")
+            for nick in self.registryValue(name, channel)
+        )
+        return [
+            nick
+            for nick in nicks
+            if nick != self.lastBomb and nick.lower() not in excluded
+        ]
+
+    def _senderMask(self, irc, sender):
         senderHostmask = irc.state.nickToHostmask(sender)
         (nick, user, host) = ircutils.splitHostmask(senderHostmask)
-        senderMask = ("{}@{}".format(user, host)).lower()
-        victim = victim.lower()
-        bombHistory.append("{}#{}#{}".format(int(time.time()), senderMask, victim))
-        self.setRegistryValue("bombHistory", bombHistory, channel)
+        return ("{}@{}".format(user, host)).lower()
+
+    def _logBomb(self, irc, channel, sender, victim):
+        self.history.add(
+            channel, int(time.time()), self._senderMask(irc, sender), victim.lower()
+        )
 
     def bombsenabled(self, irc, msg, args, channel, value):
         """[<canal>] <True|False>
@@ -455,16 +796,15 @@ class TimeBomb(callbacks.Plugin):
         DUCK! (Vai querer fazer isto se alguém lhe atirar uma bomba.)
         """
         channel = ircutils.toLower(channel)
-        try:
+        with self._lock(channel):
+            bomb = self.bombs.get(channel)
             if (
-                not self.bombs[channel].active
-                or not self.bombs[channel].rethrown
-                or not ircutils.nickEqual(self.bombs[channel].victim, msg.nick)
+                bomb is None
+                or bomb.state != bomb.THROWN
+                or not ircutils.nickEqual(bomb.victim, msg.nick)
             ):
                 return
-        except KeyError:
-            return
-        self.bombs[channel].duck(irc, msg.nick)
+            bomb.duck(irc, msg.nick)
         irc.noReply()
 
     duck = wrap(duck, ["channel"])
@@ -480,43 +820,22 @@ class TimeBomb(callbacks.Plugin):
                 " plugins.TimeBombPT.allowBombs como True para as permitir."
             )
             return
-        try:
-            if self.bombs[channel].active:
-                irc.reply(
-                    "Já existe uma bomba ativa, nas calças de {}!".format(
-                        self.bombs[channel].victim
-                    )
-                )
-                return
-        except KeyError:
-            pass
+        if self._bombActive(irc, channel):
+            return
 
         if not self._canBomb(irc, channel, msg.nick, "", True):
             return
+        overLimit = self._victimsOverLimit(channel)
 
         if self.registryValue("bombActiveUsers", channel):
             if len(nicks) == 0:
-                nicks = list(irc.state.channels[channel].users)
-                items = iter(list(self.talktimes.items()))
-                nicks = []
-                count = 0
-
-                while count < len(self.talktimes):
-                    try:
-                        item = next(items)
-                        if (
-                            time.time() - item[1]
-                            < self.registryValue("idleTime", channel) * 60
-                            and item[0] in irc.state.channels[channel].users
-                            and self._canBomb(irc, channel, msg.nick, item[0], False)
-                        ):
-                            nicks.append(item[0])
-                    except StopIteration:
-                        irc.reply(
-                            "Aconteceu algo engraçado... recebi uma exceção"
-                            " StopIteration."
-                        )
-                    count += 1
+                users = irc.state.channels[channel].users
+                cutoff = time.time() - self.registryValue("idleTime", channel) * 60
+                nicks = [
+                    nick
+                    for nick in self.activity.since(channel, cutoff)
+                    if nick in users and nick.lower() not in overLimit
+                ]
                 if len(nicks) == 1 and nicks[0] == msg.nick:
                     nicks = []
             if len(nicks) == 0:
@@ -536,15 +855,7 @@ class TimeBomb(callbacks.Plugin):
 
         if irc.nick in nicks and not self.registryValue("allowSelfBombs", channel):
             nicks.remove(irc.nick)
-        eligibleNicks = []
-
-        for victim in nicks:
-            if not (
-                victim == self.lastBomb
-                or victim.lower() in self.registryValue("randomExclusions", channel)
-                or victim.lower() in self.registryValue("exclusions", channel)
-            ) and self._canBomb(irc, channel, msg.nick, victim, False):
-                eligibleNicks.append(victim)
+        eligibleNicks = self._eligibleVictims(channel, nicks, overLimit)
 
         if len(eligibleNicks) == 0:
             irc.reply(
@@ -573,19 +884,10 @@ class TimeBomb(callbacks.Plugin):
         wires = self.rng.sample(colors, wireCount)
         goodWire = self.rng.choice(wires)
         self.log.info("TimeBomb: O fio correto é: {}".format(goodWire))
-        self._logBomb(irc, channel, msg.nick, victim)
-        self.bombs[channel] = self.Bomb(
-            irc,
-            victim,
-            wires,
-            detonateTime,
-            goodWire,
-            channel,
-            msg.nick,
-            self.registryValue("showArt", channel),
-            self.registryValue("showCorrectWire", channel),
-            self.registryValue("debug"),
-        )
+        if not self._startBomb(
+            irc, channel, msg.nick, victim, wires, detonateTime, goodWire
+        ):
+            return
 
         try:
             irc.noReply()
@@ -605,16 +907,8 @@ class TimeBomb(callbacks.Plugin):
                 " plugins.TimeBombPT.allowBombs como True para as permitir."
             )
             return
-        try:
-            if self.bombs[channel].active:
-                irc.reply(
-                    "Já existe uma bomba ativa, nas calças de {}!".format(
-                        self.bombs[channel].victim
-                    )
-                )
-                return
-        except KeyError:
-            pass
+        if self._bombActive(irc, channel):
+            return
 
         if victim.lower() == irc.nick.lower() and not self.registryValue(
             "allowSelfBombs", channel
@@ -668,19 +962,10 @@ class TimeBomb(callbacks.Plugin):
             irc.reply("Estou prestes a criar uma bomba no {}.".format(channel))
 
         # if not (victim == msg.nick and victim == 'mniip'):
-        self._logBomb(irc, channel, msg.nick, victim)
-        self.bombs[channel] = self.Bomb(
-            irc,
-            victim,
-            wires,
-            detonateTime,
-            goodWire,
-            channel,
-            msg.nick,
-            self.registryValue("showArt", channel),
-            self.registryValue("showCorrectWire", channel),
-            self.registryValue("debug"),
-        )
+        if not self._startBomb(
+            irc, channel, msg.nick, victim, wires, detonateTime, goodWire
+        ):
+            return
         if self.registryValue("debug"):
             irc.reply(
                 "Esta mensagem significa que passei a linha de criação da bomba"
@@ -697,18 +982,18 @@ class TimeBomb(callbacks.Plugin):
         Cortará o fio especificado se for bombardeado.
         """
         channel = ircutils.toLower(channel)
-        try:
-            if not self.bombs[channel].active or self.bombs[channel].rethrown:
-                return
+        with self._lock(channel):
+            bomb = self.bombs.get(channel)
+            if bomb is not None:
+                if bomb.state != bomb.ARMED:
+                    return
 
-            if not ircutils.nickEqual(
-                self.bombs[channel].victim, msg.nick
-            ) and not ircdb.checkCapability(msg.prefix, "admin"):
-                irc.reply("Não podes cortar o fio da bomba de outra pessoa!")
-                return
-            self.bombs[channel].cutwire(irc, cutWire)
-        except KeyError:
-            pass
+                if not ircutils.nickEqual(
+                    bomb.victim, msg.nick
+                ) and not ircdb.checkCapability(msg.prefix, "admin"):
+                    irc.reply("Não podes cortar o fio da bomba de outra pessoa!")
+                    return
+                bomb.cutwire(irc, cutWire)
         irc.noReply()
 
     cutwire = wrap(cutwire, ["channel", "something"])
@@ -719,8 +1004,9 @@ class TimeBomb(callbacks.Plugin):
         """
         channel = ircutils.toLower(channel)
         try:
-            if self.bombs[channel].active:
-                schedule.rescheduleEvent("{}_bomb".format(channel), time.time())
+            with self._lock(channel):
+                if self.bombs[channel].active:
+                    schedule.rescheduleEvent("{}_bomb".format(channel), time.time())
         except KeyError:
             if self.registryValue("debug"):
                 irc.reply('Tentei detonar uma bomba em "{}"'.format(channel))
@@ -736,26 +1022,22 @@ class TimeBomb(callbacks.Plugin):
         Desarma a bomba ativa (apenas operadores de canal).
         """
         channel = ircutils.toLower(channel)
-        try:
-            if self.bombs[channel].active:
-                if ircutils.nickEqual(self.bombs[channel].victim, msg.nick) and not (
-                    ircutils.nickEqual(
-                        self.bombs[channel].victim, self.bombs[channel].sender
-                    )
-                    or ircdb.checkCapability(msg.prefix, "admin")
-                ):
-                    irc.reply(
-                        "Não podes desarmar uma bomba que está nas tuas calças, apenas"
-                        " terás que cortar um fio e esperar pelo melhor."
-                    )
-                    return
-                self.bombs[channel].defuse()
-                irc.reply("Bomba desativada.")
-            else:
+        with self._lock(channel):
+            bomb = self.bombs.get(channel)
+            if bomb is None or not bomb.active:
                 irc.error("Não existem bombas ativas.")
-        except KeyError:
-            pass
-            irc.error("Não existem bombas ativas")
+                return
+            if ircutils.nickEqual(bomb.victim, msg.nick) and not (
+                ircutils.nickEqual(bomb.victim, bomb.sender)
+                or ircdb.checkCapability(msg.prefix, "admin")
+            ):
+                irc.reply(
+                    "Não podes desarmar uma bomba que está nas tuas calças, apenas"
+                    " terás que cortar um fio e esperar pelo melhor."
+                )
+                return
+            bomb.defuse()
+        irc.reply("Bomba desativada.")
 
     defuse = wrap(defuse, ["channel", ("checkChannelCapability", "op")])
 
@@ -0,0 +1,295 @@
+###
+# Copyright (c) 2010, quantumlemur
+# Copyright (c) 2020, oddluck <oddluck@riseup.net>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+import json
+import os
+import threading
+import time
+
+from supybot.test import *
+from supybot import conf, registry, schedule
+
+
+class TimeBombTestCase(ChannelPluginTestCase):
+    plugins = ("TimeBomb",)
+
+    def setUp(self):
+        super().setUp()
+        self.cb = self.irc.getCallback("TimeBomb")
+        for nick in ("alice", "bob"):
+            self.irc.feedMsg(
+                ircmsgs.join(self.channel, prefix="{0}!~{0}@{0}.example".format(nick))
+            )
+        while self.irc.takeMsg():
+            pass
+
+    def tearDown(self):
+        for bomb in self.cb.bombs.values():
+            bomb.defuse()
+        for name, event in list(schedule.schedule.events.items()):
+            if isinstance(getattr(event, "__self__", None), self.cb.Bomb):
+                schedule.removeEvent(name)
+        super().tearDown()
+
+    def arm(self, channel=None, victim="bob"):
+        channel = channel or self.channel
+        self.assertTrue(
+            self.cb._startBomb(
+                self.irc, channel, "alice", victim, ["red", "blue"], 100, "red"
+            )
+        )
+        while self.irc.takeMsg():
+            pass
+        return self.cb.bombs[channel]
+
+    def reinvites(self):
+        return sum(
+            getattr(event, "__name__", "") == "_reinvite"
+            for event in schedule.schedule.events.values()
+        )
+
+    def testCountsPerSenderAndVictim(self):
+        now = time.time()
+        self.cb.history.add(self.channel, now - 3, "alice@a.example", "bob")
+        self.cb.history.add(self.channel, now - 2, "alice@a.example", "carol")
+        self.cb.history.add(self.channel, now - 1, "bob@b.example", "carol")
+        self.cb.history.add("#other", now, "alice@a.example", "carol")
+        cutoff = now - 60
+        self.assertEqual(
+            self.cb.history.counts(self.channel, "alice@a.example", "carol", cutoff),
+            (3, 2, 2),
+        )
+        self.assertEqual(
+            self.cb.history.counts(self.channel, "bob@b.example", "bob", cutoff),
+            (3, 1, 1),
+        )
+        self.assertEqual(
+            self.cb.history.counts("#other", "bob@b.example", "bob", cutoff),
+            (1, 0, 0),
+        )
+        self.assertEqual(
+            self.cb.history.victimsOver(self.channel, 1, cutoff), {"carol"}
+        )
+
+    def testWindowExpiry(self):
+        now = time.time()
+        self.cb.history.add(self.channel, now - 100, "alice@a.example", "bob")
+        self.cb.history.add(self.channel, now - 10, "alice@a.example", "bob")
+        self.cb.history.dirty = False
+        self.assertEqual(
+            self.cb.history.counts(self.channel, "alice@a.example", "bob", now - 50),
+            (1, 1, 1),
+        )
+        self.assertTrue(self.cb.history.dirty)
+        self.cb.history.expire(self.channel, now)
+        self.assertNotIn(self.channel, self.cb.history.channels)
+        self.assertEqual(
+            self.cb.history.counts(self.channel, "alice@a.example", "bob", 0),
+            (0, 0, 0),
+        )
+
+    def testRateLimitUsesHistory(self):
+        # rateLimitTime 1800s * rateLimitVictim 2/h allows one bomb per victim
+        with conf.supybot.plugins.TimeBomb.rateLimitVictim.context(2.0):
+            self.cb.history.add(self.channel, time.time(), "x@y.example", "bob")
+            self.assertTrue(
+                self.cb._canBomb(self.irc, self.channel, "alice", "bob", False)
+            )
+            self.cb.history.add(self.channel, time.time(), "x@y.example", "bob")
+            self.assertFalse(
+                self.cb._canBomb(self.irc, self.channel, "alice", "bob", False)
+            )
+            self.assertEqual(self.cb._victimsOverLimit(self.channel), {"bob"})
+
+    def testSaveAndReload(self):
+        now = time.time()
+        self.cb.history.add(self.channel, 1, "old@o.example", "bob")
+        self.cb.history.add(self.channel, now, "alice@a.example", "bob")
+        self.cb._saveHistory()
+        self.assertFalse(self.cb.history.dirty)
+        with open(self.cb.historyFile) as fd:
+            # The expired bomb is not written out
+            self.assertEqual(
+                json.load(fd), {self.channel: [[now, "alice@a.example", "bob"]]}
+            )
+        self.assertNotError("reload TimeBomb")
+        self.cb = self.irc.getCallback("TimeBomb")
+        self.assertFalse(self.cb.history.dirty)
+        self.assertEqual(
+            self.cb.history.counts(self.channel, "alice@a.example", "bob", now - 1),
+            (1, 1, 1),
+        )
+
+    def testDamagedHistoryIsDropped(self):
+        for data in (
+            "{not json",
+            json.dumps([1, 2]),
+            json.dumps({"#a": 5}),
+            json.dumps({"#a": [[1, "x"]]}),
+            json.dumps({"#a": [["x", "a", "b"]]}),
+        ):
+            with open(self.cb.historyFile, "w") as fd:
+                fd.write(data)
+            self.cb.history.add("#a", 1, "a", "b")
+            self.cb._loadHistory()
+            self.assertEqual(self.cb.history.channels, {})
+
+    def testImportsRegistryHistoryOnce(self):
+        if os.path.exists(self.cb.historyFile):
+            os.remove(self.cb.historyFile)
+        now = int(time.time())
+        key = "supybot.plugins.TimeBomb.bombHistory." + self.channel
+        registry._cache[key] = "{0}#alice@a.example#bob {1}#x@y#carol bad".format(
+            now, now - 10
+        )
+        try:
+            self.cb._loadHistory()
+            self.assertTrue(self.cb.history.dirty)
+            self.assertEqual(
+                self.cb.history.counts(self.channel, "alice@a.example", "bob", 0),
+                (2, 1, 1),
+            )
+            self.cb._saveHistory()
+            self.cb.history = type(self.cb.history)()
+            self.cb._loadHistory()
+            # Read back from TimeBomb.json, not imported a second time
+            self.assertEqual(
+                self.cb.history.counts(self.channel, "x@y", "carol", 0), (2, 1, 1)
+            )
+        finally:
+            del registry._cache[key]
+
+    def testGoodWireThrowsBackAndDuckDefuses(self):
+        bomb = self.arm()
+        self.assertEqual(bomb.state, bomb.ARMED)
+        with bomb.lock:
+            bomb.cutwire(self.irc, "RED")
+        self.assertEqual(bomb.state, bomb.THROWN)
+        self.assertEqual((bomb.victim, bomb.sender), ("alice", "bob"))
+        self.assertIn("{}_bomb".format(self.channel), schedule.schedule.events)
+        with bomb.lock:
+            # Only the new victim may duck, and cutting does nothing now
+            bomb.duck(self.irc, "bob")
+            bomb.cutwire(self.irc, "blue")
+            self.assertEqual(bomb.state, bomb.THROWN)
+            bomb.duck(self.irc, "Alice")
+        self.assertEqual(bomb.state, bomb.DEFUSED)
+        self.assertFalse(bomb.active)
+        self.assertNotIn("{}_bomb".format(self.channel), schedule.schedule.events)
+
+    def testThrownBombExplodesWithoutReinvite(self):
+        bomb = self.arm()
+        with bomb.lock:
+            bomb.cutwire(self.irc, "red")
+        before = self.reinvites()
+        bomb._timeout()
+        self.assertEqual(bomb.state, bomb.EXPLODED)
+        self.assertEqual(self.reinvites(), before)
+
+    def testWrongWireExplodes(self):
+        bomb = self.arm()
+        with bomb.lock:
+            bomb.cutwire(self.irc, "blue")
+        self.assertEqual(bomb.state, bomb.EXPLODED)
+        self.assertNotIn("{}_bomb".format(self.channel), schedule.schedule.events)
+        kicks = []
+        msg = self.irc.takeMsg()
+        while msg is not None:
+            if msg.command == "KICK":
+                kicks.append(msg.args[1])
+            msg = self.irc.takeMsg()
+        self.assertEqual(kicks, ["bob"])
+        # Final states ignore everything else
+        bomb._timeout()
+        bomb.defuse()
+        self.assertEqual(bomb.state, bomb.EXPLODED)
+
+    def testTimeoutReinvitesVictimWhoNeverCut(self):
+        bomb = self.arm()
+        before = self.reinvites()
+        bomb._timeout()
+        self.assertEqual(bomb.state, bomb.EXPLODED)
+        self.assertEqual(self.reinvites(), before + 1)
+
+    def testSecondBombIsRefused(self):
+        with conf.supybot.plugins.TimeBomb.allowBombs.context(True):
+            bomb = self.arm()
+            self.assertResponse(
+                "timebomb alice", "Já existe uma bomba ativa, nas calças de bob!"
+            )
+            self.assertIs(self.cb.bombs[self.channel], bomb)
+            bomb.defuse()
+            self.arm(victim="alice")
+
+    def testBotCutsItsOwnWireWithoutBlocking(self):
+        started = time.time()
+        bomb = self.arm(victim=self.irc.nick)
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual(bomb.state, bomb.ARMED)
+        self.assertIn(bomb.cutWire, ("red", "blue"))
+        self.assertTrue(
+            any(
+                getattr(event, "__name__", "") == "_announceCut"
+                for event in schedule.schedule.events.values()
+            )
+        )
+        cut = None
+        deadline = time.time() + 5
+        while time.time() < deadline and (cut is None or bomb.state == bomb.ARMED):
+            time.sleep(0.05)
+            schedule.run()
+            msg = self.irc.takeMsg()
+            while msg is not None:
+                if msg.command == "PRIVMSG" and msg.args[1].startswith("$cutwire"):
+                    cut = msg.args[1]
+                msg = self.irc.takeMsg()
+        self.assertEqual(cut, "$cutwire {}".format(bomb.cutWire))
+        self.assertNotEqual(bomb.state, bomb.ARMED)
+
+    def testLocksArePerChannel(self):
+        self.assertIs(self.cb._lock("#a"), self.cb._lock("#a"))
+        self.assertIsNot(self.cb._lock("#a"), self.cb._lock("#b"))
+        other = threading.Thread(target=self.arm, args=("#b",))
+        blocked = threading.Thread(target=self.arm, args=("#a",))
+        with self.cb._lock("#a"):
+            other.start()
+            other.join(2)
+            self.assertFalse(other.is_alive())
+            blocked.start()
+            blocked.join(0.2)
+            self.assertTrue(blocked.is_alive())
+            self.assertNotIn("#a", self.cb.bombs)
+        blocked.join(2)
+        self.assertFalse(blocked.is_alive())
+        self.assertIs(self.cb.bombs["#a"].lock, self.cb._lock("#a"))
+        self.assertIs(self.cb.bombs["#b"].lock, self.cb._lock("#b"))
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: